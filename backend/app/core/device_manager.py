@@ -383,7 +383,6 @@ class DeviceManager:
                 if interface and interface != 'unknown':
                     # Пробуем получить IP интерфейса
                     try:
-                        import netifaces
                         if interface in netifaces.interfaces():
                             addrs = netifaces.ifaddresses(interface)
                             if netifaces.AF_INET in addrs:
@@ -558,7 +557,7 @@ class DeviceManager:
                         response = json.loads(stdout.decode())
                         external_ip = response.get('origin')
                         if external_ip:
-                            logger.debug(f"Got external IP for {adb_id} via interface {interface}: {external_ip}")
+                            logger.debug("Got external IP via interface", adb_id=adb_id, interface=interface, external_ip=external_ip)
                             return external_ip
                     except json.JSONDecodeError:
                         # Пробуем найти IP в тексте
@@ -566,7 +565,7 @@ class DeviceManager:
                         if ip_match:
                             return ip_match.group(1)
             except Exception as e:
-                logger.debug(f"Method 1 failed for {adb_id}: {e}")
+                logger.debug("Method 1 failed", adb_id=adb_id, error=str(e))
 
             # Метод 2: Через ADB (резервный)
             try:
@@ -583,12 +582,12 @@ class DeviceManager:
                         response = json.loads(stdout.decode())
                         external_ip = response.get('origin')
                         if external_ip:
-                            logger.debug(f"Got external IP for {adb_id} via ADB: {external_ip}")
+                            logger.debug("Got external IP via ADB", adb_id=adb_id, external_ip=external_ip)
                             return external_ip
                     except json.JSONDecodeError:
                         pass
             except Exception as e:
-                logger.debug(f"Method 2 failed for {adb_id}: {e}")
+                logger.debug("Method 2 failed", adb_id=adb_id, error=str(e))
 
             logger.warning(f"All methods failed to get external IP for Android device {adb_id}")
             return None
@@ -604,7 +603,7 @@ class DeviceManager:
         try:
             # Получаем список всех сетевых интерфейсов
             all_interfaces = netifaces.interfaces()
-            logger.debug(f"All network interfaces: {all_interfaces}")
+            logger.debug("All network interfaces", interfaces=all_interfaces)
 
             # Возможные шаблоны имен USB интерфейсов для Android
             android_patterns = [
@@ -623,7 +622,7 @@ class DeviceManager:
                         # Проверяем, что интерфейс активен и имеет IP
                         if self._interface_has_ip(interface):
                             candidate_interfaces.append(interface)
-                            logger.debug(f"Found candidate interface: {interface}")
+                            logger.debug("Found candidate interface", interface=interface)
 
             if not candidate_interfaces:
                 logger.warning(f"No active USB interfaces found for device {device_id}")
@@ -697,7 +696,7 @@ class DeviceManager:
                 return False
 
         except Exception as e:
-            logger.debug(f"Error verifying interface {interface} for device {device_id}: {e}")
+            logger.debug("Error verifying interface", interface=interface, device_id=device_id, error=str(e))
             return False
 
     async def update_device_status(self, device_id: str, status: str):
@@ -798,8 +797,7 @@ class DeviceManager:
 
     async def get_device_proxy_route(self, device_id: str) -> Optional[dict]:
         """Получение маршрута для проксирования через Android устройство"""
-        all_devices = await self.get_all_devices()
-        device = all_devices.get(device_id)
+        device = await self.get_device_by_id(device_id)
 
         if not device:
             return None
@@ -1,13 +1,22 @@
 # backend/app/core/enhanced_rotation_manager.py - ОБНОВЛЕННАЯ ВЕРСИЯ С USB ПЕРЕЗАГРУЗКОЙ
 
 import asyncio
+import os
 import subprocess
 import uuid
 import time
 import re
+import socket
+import struct
+import aiohttp
+import netifaces
+from collections import defaultdict
+from pathlib import Path
+from types import MappingProxyType
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List, Tuple
-from sqlalchemy import select, update
+from sqlalchemy import select, update, insert, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 import structlog
 
@@ -16,40 +25,124 @@ from ..models.base import ProxyDevice, RotationConfig, IpHistory
 
 logger = structlog.get_logger()
 
+# Готовые UPDATE для результата ротации: без смены IP и со сменой IP (значения - через параметры)
+_UPD_DEVICE_ROTATION = update(ProxyDevice).where(
+    ProxyDevice.id == bindparam('b_id')
+).values(last_ip_rotation=bindparam('b_now'))
+
+_UPD_DEVICE_ROTATION_IP = update(ProxyDevice).where(
+    ProxyDevice.id == bindparam('b_id')
+).values(
+    last_ip_rotation=bindparam('b_now'),
+    current_external_ip=bindparam('b_ip'),
+    updated_at=bindparam('b_now')
+)
+
+# Шаблоны разбора вывода lsusb, ip route и сервисов определения IP
+_RE_LSUSB = re.compile(r'Bus (\d+) Device (\d+)')
+_RE_ROUTE_VIA = re.compile(r'via (\d+\.\d+\.\d+\.\d+)')
+_RE_IPV4 = re.compile(r'(\d+\.\d+\.\d+\.\d+)')
+
+# Время жизни кэша IP модема (шлюза интерфейса), секунд
+MODEM_IP_CACHE_TTL = 300
+
+# Время стабилизации соединения после ротации по типам устройств, секунд
+STABILIZATION_DELAYS = MappingProxyType({
+    'android': 8,
+    'usb_modem': 10,  # Увеличено для USB перезагрузки
+    'raspberry_pi': 15,
+    'network_device': 5
+})
+
+# Метод ротации по умолчанию для новых конфигураций
+DEFAULT_ROTATION_METHODS = MappingProxyType({
+    'android': 'data_toggle',
+    'usb_modem': 'usb_reboot',  # Единственный метод для USB модемов
+    'raspberry_pi': 'ppp_restart',
+    'network_device': 'interface_restart'
+})
+
+# Запись истории IP пачками: максимальный размер пачки и время накопления, секунд
+IP_HISTORY_BATCH_SIZE = 200
+IP_HISTORY_FLUSH_INTERVAL = 0.5
+
+# Максимум одновременно запущенных внешних команд
+MAX_CONCURRENT_SUBPROCESSES = 16
+
+# Маркер конца вывода команды в постоянной adb shell сессии
+ADB_END_MARKER = '__ADB_END__'
+
+# Netlink: группа уведомлений об IPv4 адресах и тип сообщения о новом адресе
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_NEWADDR = 20
+
+# Типы ICMP сообщений для проверки доступности модема
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
 
 class EnhancedRotationManager:
     """Улучшенный менеджер ротации IP с USB перезагрузкой для Huawei E3372h модемов"""
 
+    # Обработчики обновления внешнего IP для каждого типа устройства
+    _EXTERNAL_IP_REFRESHERS = {
+        'android': '_refresh_android_external_ip',
+        'usb_modem': '_refresh_usb_modem_external_ip',
+    }
+
+    # Сервисы определения внешнего IP (опрашиваются параллельно)
+    _EXTERNAL_IP_SERVICES = ('https://2ip.ru', 'https://ifconfig.me')
+
+    # Поддерживаемые методы ротации для каждого типа устройства
+    rotation_methods = MappingProxyType({
+        'android': frozenset({
+            'data_toggle',
+            'airplane_mode',
+            'usb_reconnect',
+            'network_interface_reset'
+        }),
+        'usb_modem': frozenset({
+            'usb_reboot',  # ЕДИНСТВЕННЫЙ метод для E3372h
+        }),
+        'raspberry_pi': frozenset({
+            'ppp_restart',
+            'gpio_reset',
+            'usb_reset',
+            'interface_restart'
+        }),
+        'network_device': frozenset({
+            'interface_restart',
+            'dhcp_renew',
+            'network_reset'
+        })
+    })
+
+    # Обработчики методов ротации Android устройств
+    _ANDROID_ROTATIONS = {
+        'data_toggle': '_android_data_toggle',
+        'airplane_mode': '_android_airplane_mode',
+        'usb_reconnect': '_android_usb_reconnect',
+        'network_interface_reset': '_android_interface_reset',
+    }
+
     def __init__(self):
         self.rotation_tasks: Dict[str, asyncio.Task] = {}
-        self.rotation_in_progress: Dict[str, bool] = {}
+        # Блокировки ротации по устройствам - не более одной ротации на устройство
+        self._device_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
         self.device_manager = None
         self.modem_manager = None
         self._running = False
-
-        # Поддерживаемые методы ротации для каждого типа устройства
-        self.rotation_methods = {
-            'android': [
-                'data_toggle',
-                'airplane_mode',
-                'usb_reconnect',
-                'network_interface_reset'
-            ],
-            'usb_modem': [
-                'usb_reboot',  # ЕДИНСТВЕННЫЙ метод для E3372h
-            ],
-            'raspberry_pi': [
-                'ppp_restart',
-                'gpio_reset',
-                'usb_reset',
-                'interface_restart'
-            ],
-            'network_device': [
-                'interface_restart',
-                'dhcp_renew',
-                'network_reset'
-            ]
-        }
+        # Кэш sysfs путей USB устройств модемов (имя устройства -> путь)
+        self._usb_auth_path_cache: Dict[str, str] = {}
+        # Кэш IP модемов (интерфейс -> (IP, время получения))
+        self._modem_ip_cache: Dict[str, Tuple[str, float]] = {}
+        # Постоянные adb shell сессии Android устройств
+        self._adb_shells: Dict[str, asyncio.subprocess.Process] = {}
+        # Ограничение числа одновременно запущенных внешних команд
+        self._proc_sem = asyncio.Semaphore(MAX_CONCURRENT_SUBPROCESSES)
+        # Очередь записей истории IP и фоновая задача их записи в БД
+        self._ip_history_queue: asyncio.Queue = asyncio.Queue()
+        self._ip_history_flusher_task: Optional[asyncio.Task] = None
 
     async def start(self):
         """Запуск менеджера ротации"""
@@ -60,39 +153,14 @@ class EnhancedRotationManager:
         self._running = True
         logger.info("Starting enhanced rotation manager with USB reboot support")
 
+        # Фоновая запись истории IP
+        self._ip_history_flusher_task = asyncio.create_task(self._ip_history_flusher())
+
         # Запуск задач ротации для всех активных устройств
         await self.start_all_rotation_tasks()
 
-        # Запуск фонового мониторинга
-        asyncio.create_task(self._monitor_rotation_tasks())
-
     # backend/app/core/enhanced_rotation_manager.py - ИСПРАВЛЕННАЯ ВЕРСИЯ МЕТОДОВ РОТАЦИИ
 
-    async def _create_default_rotation_config(self, device: ProxyDevice) -> RotationConfig:
-        """Создание конфигурации ротации по умолчанию с правильными методами"""
-        default_methods = {
-            'android': 'data_toggle',
-            'usb_modem': 'usb_reboot',  # ТОЛЬКО USB ПЕРЕЗАГРУЗКА для модемов
-            'raspberry_pi': 'ppp_restart',
-            'network_device': 'interface_restart'
-        }
-
-        method = default_methods.get(device.device_type, 'data_toggle')
-
-        config = RotationConfig(
-            device_id=device.id,
-            rotation_method=method,
-            rotation_interval=600,
-            auto_rotation=True
-        )
-
-        async with AsyncSessionLocal() as db:
-            db.add(config)
-            await db.commit()
-            await db.refresh(config)
-
-        return config
-
     # Поддерживаемые методы ротации для каждого типа устройства
 
 
@@ -113,104 +181,105 @@ class EnhancedRotationManager:
             return False, "Invalid device ID format"
 
         # Проверка, не происходит ли уже ротация
-        if self.rotation_in_progress.get(device_id, False):
+        lock = self._device_locks[device_id]
+        if lock.locked():
             return False, "Rotation already in progress"
 
-        self.rotation_in_progress[device_id] = True
-
+        await lock.acquire()
         try:
-            # Получение информации об устройстве
+            # Получение устройства и его конфигурации ротации одним запросом
             async with AsyncSessionLocal() as db:
-                stmt = select(ProxyDevice).where(ProxyDevice.id == device_uuid)
+                stmt = select(ProxyDevice, RotationConfig).outerjoin(
+                    RotationConfig, RotationConfig.device_id == ProxyDevice.id
+                ).where(ProxyDevice.id == device_uuid)
                 result = await db.execute(stmt)
-                device = result.scalar_one_or_none()
+                row = result.first()
 
-                if not device:
+                if not row:
                     return False, "Device not found"
 
-                # Получение конфигурации ротации
-                stmt = select(RotationConfig).where(
-                    RotationConfig.device_id == device_uuid
-                )
-                result = await db.execute(stmt)
-                config = result.scalar_one_or_none()
+                device, config = row
 
                 if not config:
-                    # Создание конфигурации по умолчанию
-                    config = await self._create_default_rotation_config(device)
+                    # Создание конфигурации по умолчанию в той же сессии
+                    config = await self._create_default_rotation_config(device, db)
+                    await db.commit()
 
-                # Для USB модемов E3372h используем только USB перезагрузку
-                if device.device_type == 'usb_modem':
-                    rotation_method = 'usb_reboot'
-                else:
-                    rotation_method = force_method or config.rotation_method
+            # Дальше работаем без сессии - соединение из пула не удерживается на время ротации
+
+            # Для USB модемов E3372h используем только USB перезагрузку
+            if device.device_type == 'usb_modem':
+                rotation_method = 'usb_reboot'
+            else:
+                rotation_method = force_method or config.rotation_method
+
+            if rotation_method not in self.rotation_methods.get(device.device_type, ()):
+                return False, f"Unsupported rotation method {rotation_method} for {device.device_type}"
 
+            logger.info(
+                "Starting IP rotation with USB reboot",
+                device_id=device_id,
+                device_name=device.name,
+                device_type=device.device_type,
+                rotation_method=rotation_method
+            )
+
+            # Получаем текущий IP ДО ротации
+            old_ip = await self._get_current_device_ip(device)
+            logger.info("Current IP before rotation", device_id=device_id, ip=old_ip)
+
+            # Выполнение ротации в зависимости от типа устройства
+            success, message = await self._execute_rotation(device, rotation_method)
+
+            if success:
                 logger.info(
-                    "Starting IP rotation with USB reboot",
+                    "IP rotation completed successfully",
                     device_id=device_id,
                     device_name=device.name,
-                    device_type=device.device_type,
-                    rotation_method=rotation_method
+                    method=rotation_method,
+                    message=message
                 )
 
-                # Получаем текущий IP ДО ротации
-                old_ip = await self._get_current_device_ip(device)
-                logger.info(f"Current IP before rotation: {old_ip}")
-
-                # Выполнение ротации в зависимости от типа устройства
-                success, message = await self._execute_rotation(device, rotation_method)
-
-                # Обновление статистики
-                await self._update_rotation_stats(device_id, success)
-
-                if success:
-                    logger.info(
-                        "IP rotation completed successfully",
-                        device_id=device_id,
-                        device_name=device.name,
-                        method=rotation_method,
-                        message=message
-                    )
-
-                    # Ожидание стабилизации соединения
-                    await asyncio.sleep(self._get_stabilization_delay(device.device_type))
-
-                    # Получение нового IP и проверка изменения
-                    new_ip = await self._verify_ip_change(device, old_ip)
-
-                    if new_ip:
-                        # Обновление IP в базе данных
-                        await self._update_device_ip(device_id, new_ip)
-                        await self._save_ip_history(device_id, new_ip)
-
-                        if new_ip != old_ip:
-                            logger.info(
-                                "New IP obtained successfully",
-                                device_id=device_id,
-                                old_ip=old_ip,
-                                new_ip=new_ip,
-                                method=rotation_method
-                            )
-                            return True, new_ip
-                        else:
-                            logger.info(
-                                "Rotation completed but IP unchanged",
-                                device_id=device_id,
-                                ip=new_ip,
-                                method=rotation_method
-                            )
-                            return True, f"Rotation completed successfully. IP unchanged: {new_ip}"
+                # Ожидание стабилизации соединения
+                await asyncio.sleep(self._get_stabilization_delay(device.device_type))
+
+                # Получение нового IP и проверка изменения
+                new_ip = await self._verify_ip_change(device, old_ip)
+
+                # Статистика, новый IP и история - одной транзакцией
+                await self._save_rotation_result(device_uuid, new_ip, device.current_external_ip)
+
+                if new_ip:
+                    if new_ip != old_ip:
+                        logger.info(
+                            "New IP obtained successfully",
+                            device_id=device_id,
+                            old_ip=old_ip,
+                            new_ip=new_ip,
+                            method=rotation_method
+                        )
+                        return True, new_ip
                     else:
-                        return False, f"Could not verify IP change after rotation"
+                        logger.info(
+                            "Rotation completed but IP unchanged",
+                            device_id=device_id,
+                            ip=new_ip,
+                            method=rotation_method
+                        )
+                        return True, f"Rotation completed successfully. IP unchanged: {new_ip}"
                 else:
-                    logger.error(
-                        "IP rotation failed",
-                        device_id=device_id,
-                        device_name=device.name,
-                        method=rotation_method,
-                        error=message
-                    )
-                    return False, message
+                    return False, f"Could not verify IP change after rotation"
+            else:
+                await self._save_rotation_result(device_uuid)
+
+                logger.error(
+                    "IP rotation failed",
+                    device_id=device_id,
+                    device_name=device.name,
+                    method=rotation_method,
+                    error=message
+                )
+                return False, message
 
         except Exception as e:
             logger.error(
@@ -220,7 +289,7 @@ class EnhancedRotationManager:
             )
             return False, f"Rotation error: {str(e)}"
         finally:
-            self.rotation_in_progress[device_id] = False
+            lock.release()
 
     async def _execute_rotation(self, device: ProxyDevice, method: str) -> Tuple[bool, str]:
         """Выполнение ротации в зависимости от типа устройства и метода"""
@@ -242,7 +311,7 @@ class EnhancedRotationManager:
             else:
                 return False, f"Unsupported device type: {device_type}"
         except Exception as e:
-            logger.error(f"Rotation execution error for device UUID {device.id}: {str(e)}")
+            logger.exception("Rotation execution error", device_id=str(device.id))
             return False, f"Rotation execution error: {str(e)}"
 
     async def _rotate_usb_modem_via_reboot(self, device: ProxyDevice) -> Tuple[bool, str]:
@@ -263,21 +332,30 @@ class EnhancedRotationManager:
             old_external_ip = await self._get_external_ip_via_interface(interface)
             logger.info(f"External IP before USB reboot: {old_external_ip}")
 
-            # Выполняем USB перезагрузку
-            reboot_success, reboot_message = await self._perform_usb_reboot()
+            # Мониторинг запускаем до перезагрузки, чтобы не пропустить отключение модема
+            monitor_task = asyncio.create_task(self._monitor_usb_reboot(interface))
 
-            if not reboot_success:
-                return False, f"USB reboot failed: {reboot_message}"
+            try:
+                # Выполняем USB перезагрузку
+                reboot_success, reboot_message = await self._perform_usb_reboot(device_name, interface)
+
+                if not reboot_success:
+                    # Путь и шлюз могли измениться после переподключения модема
+                    self._usb_auth_path_cache.pop(device_name, None)
+                    self._modem_ip_cache.pop(interface, None)
+                    return False, f"USB reboot failed: {reboot_message}"
 
-            # Мониторинг перезагрузки
-            monitor_success, monitor_message = await self._monitor_usb_reboot(interface)
+                # Мониторинг перезагрузки
+                monitor_success, monitor_message = await monitor_task
+            finally:
+                monitor_task.cancel()
 
             if not monitor_success:
                 logger.warning(f"USB reboot monitor warning: {monitor_message}")
                 # Продолжаем даже если мониторинг не идеален
 
-            # Дополнительная пауза для стабилизации
-            await asyncio.sleep(5)
+            # Дополнительная пауза для стабилизации - до появления IP на интерфейсе
+            await self._wait_for_interface_ip(interface, timeout=5)
 
             # Получаем новый внешний IP
             new_external_ip = await self._get_external_ip_via_interface(interface)
@@ -312,25 +390,49 @@ class EnhancedRotationManager:
             logger.error(f"Error getting modem interface: {e}")
             return None
 
-    async def _perform_usb_reboot(self) -> Tuple[bool, str]:
+    async def _run(self, *argv: str, input: Optional[bytes] = None) -> Tuple[int, bytes, bytes]:
+        """Запуск внешней команды с ограничением числа одновременных процессов"""
+        async with self._proc_sem:
+            proc = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=asyncio.subprocess.PIPE if input is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await proc.communicate(input=input)
+            return proc.returncode, stdout, stderr
+
+    async def _perform_usb_reboot(self, device_name: str, interface: str) -> Tuple[bool, str]:
         """
         Выполнение USB перезагрузки модема - ИСПРАВЛЕННАЯ ВЕРСИЯ
         """
         try:
             logger.info("Starting USB reboot...")
 
-            # Шаг 1: Поиск USB устройства Huawei
+            device_path = self._usb_auth_path_cache.get(device_name)
+            if device_path:
+                logger.info(f"Using cached USB device path: {device_path}")
+                return await self._toggle_usb_authorized(device_path)
+
             usb_vid = "12d1"  # Vendor ID для Huawei
 
-            # Получаем информацию о USB устройстве
-            result = await asyncio.create_subprocess_exec(
-                'lsusb',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
+            # Шаг 1: sysfs путь именно этого модема - по его сетевому интерфейсу; кэшируем только его
+            device_path = await asyncio.to_thread(self._usb_device_path_for_interface, interface, usb_vid)
+            if device_path:
+                self._usb_auth_path_cache[device_name] = device_path
+                return await self._toggle_usb_authorized(device_path)
+
+            # Интерфейс не сопоставился с USB устройством - первый найденный модем Huawei, без кэширования
+            device_path = await self._find_usb_device_path(usb_vid)
+            if device_path:
+                logger.warning("USB device not matched by interface, using first Huawei device",
+                               interface=interface, device_path=device_path)
+                return await self._toggle_usb_authorized(device_path)
+
+            # Шаг 2: sysfs путь не найден - ищем устройство через lsusb для usbreset
+            returncode, stdout, stderr = await self._run('lsusb')
 
-            if result.returncode != 0:
+            if returncode != 0:
                 return False, f"lsusb command failed: {stderr.decode()}"
 
             # Ищем Huawei устройство
@@ -345,7 +447,7 @@ class EnhancedRotationManager:
                 return False, "Huawei USB device not found"
 
             # Извлекаем bus и device
-            bus_match = re.search(r'Bus (\d+) Device (\d+)', huawei_line)
+            bus_match = _RE_LSUSB.search(huawei_line)
             if not bus_match:
                 return False, "Could not parse USB device info"
 
@@ -354,47 +456,34 @@ class EnhancedRotationManager:
 
             logger.info(f"Found Huawei USB device: Bus {bus} Device {device}")
 
-            # Шаг 2: Запуск диагностики если нужно
-            # await self._debug_usb_device_structure(usb_vid)
+            # Попробуем альтернативный метод через usbreset
+            logger.warning("Could not find sysfs path, trying usbreset method...")
+            return await self._usbreset_method(bus, device)
 
-            # Шаг 3: Поиск sysfs пути к устройству
-            device_path = await self._find_usb_device_path(usb_vid)
-            if not device_path:
-                # Попробуем альтернативный метод через usbreset
-                logger.warning("Could not find sysfs path, trying usbreset method...")
-                return await self._usbreset_method(bus, device)
+        except Exception as e:
+            logger.error(f"Error during USB reboot: {e}")
+            return False, f"USB reboot error: {str(e)}"
 
+    async def _toggle_usb_authorized(self, device_path: str) -> Tuple[bool, str]:
+        """Отключение и включение USB устройства через sysfs файл authorized"""
+        try:
             auth_file = f"{device_path}/authorized"
             logger.info(f"Using authorization file: {auth_file}")
 
             # Шаг 4: Отключение USB устройства
             logger.info("Disabling USB device...")
-            result = await asyncio.create_subprocess_exec(
-                'sudo', 'tee', auth_file,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate(input=b'0')
-
-            if result.returncode != 0:
-                return False, f"Failed to disable USB device: {stderr.decode()}"
+            success, error = await self._write_usb_authorized(auth_file, b'0')
+            if not success:
+                return False, f"Failed to disable USB device: {error}"
 
             # Пауза для отключения
             await asyncio.sleep(2)
 
             # Шаг 5: Включение USB устройства
             logger.info("Enabling USB device...")
-            result = await asyncio.create_subprocess_exec(
-                'sudo', 'tee', auth_file,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate(input=b'1')
-
-            if result.returncode != 0:
-                return False, f"Failed to enable USB device: {stderr.decode()}"
+            success, error = await self._write_usb_authorized(auth_file, b'1')
+            if not success:
+                return False, f"Failed to enable USB device: {error}"
 
             logger.info("USB reboot completed successfully")
             return True, "USB reboot completed"
@@ -403,32 +492,41 @@ class EnhancedRotationManager:
             logger.error(f"Error during USB reboot: {e}")
             return False, f"USB reboot error: {str(e)}"
 
+    @staticmethod
+    def _write_sysfs(path: str, value: bytes):
+        """Прямая запись значения в sysfs файл"""
+        with open(path, 'wb', buffering=0) as f:
+            f.write(value)
+
+    async def _write_usb_authorized(self, auth_file: str, value: bytes) -> Tuple[bool, str]:
+        """Запись в файл authorized напрямую, через sudo tee если не хватает прав"""
+        try:
+            await asyncio.to_thread(self._write_sysfs, auth_file, value)
+            return True, ""
+        except PermissionError:
+            logger.debug("No direct write access to authorized file, using sudo", auth_file=auth_file)
+
+        returncode, stdout, stderr = await self._run('sudo', 'tee', auth_file, input=value)
+        return returncode == 0, stderr.decode()
+
     async def _usbreset_method(self, bus: str, device: str) -> Tuple[bool, str]:
         """Альтернативный метод через usbreset"""
         try:
             logger.info(f"Trying usbreset method for Bus {bus} Device {device}")
 
             # Попробуем найти usbreset
-            result = await asyncio.create_subprocess_exec(
-                'which', 'usbreset',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
+            returncode, stdout, stderr = await self._run('which', 'usbreset')
 
-            if result.returncode == 0:
+            if returncode == 0:
                 usbreset_path = stdout.decode().strip()
                 logger.info(f"Found usbreset at: {usbreset_path}")
 
                 # Выполняем usbreset
-                result = await asyncio.create_subprocess_exec(
-                    'sudo', usbreset_path, f'/dev/bus/usb/{bus.zfill(3)}/{device.zfill(3)}',
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
+                returncode, stdout, stderr = await self._run(
+                    'sudo', usbreset_path, f'/dev/bus/usb/{bus.zfill(3)}/{device.zfill(3)}'
                 )
-                stdout, stderr = await result.communicate()
 
-                if result.returncode == 0:
+                if returncode == 0:
                     logger.info("USB reset via usbreset completed successfully")
                     return True, "USB reset completed via usbreset"
                 else:
@@ -438,21 +536,11 @@ class EnhancedRotationManager:
             logger.info("Trying kernel module reset...")
 
             # Перезагружаем модуль cdc_ether
-            result = await asyncio.create_subprocess_exec(
-                'sudo', 'modprobe', '-r', 'cdc_ether',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
+            await self._run('sudo', 'modprobe', '-r', 'cdc_ether')
 
             await asyncio.sleep(2)
 
-            result = await asyncio.create_subprocess_exec(
-                'sudo', 'modprobe', 'cdc_ether',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
+            await self._run('sudo', 'modprobe', 'cdc_ether')
 
             await asyncio.sleep(5)
 
@@ -463,121 +551,15 @@ class EnhancedRotationManager:
             return False, f"Alternative USB reset failed: {str(e)}"
 
     async def _find_usb_device_path(self, vendor_id: str) -> Optional[str]:
-        """Поиск sysfs пути к USB устройству - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+        """Поиск sysfs пути к USB устройству"""
         try:
             logger.info(f"Searching for USB device with vendor ID: {vendor_id}")
 
-            # Метод 1: Поиск через find команду
-            result = await asyncio.create_subprocess_exec(
-                'find', '/sys/bus/usb/devices/', '-name', 'idVendor',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode != 0:
-                logger.error(f"Find command failed: {stderr.decode()}")
-                return None
-
-            # Проверяем каждый найденный файл
-            for vendor_file in stdout.decode().split('\n'):
-                if not vendor_file.strip():
-                    continue
-
-                try:
-                    # Читаем содержимое файла
-                    with open(vendor_file, 'r') as f:
-                        file_vendor_id = f.read().strip()
-
-                    if file_vendor_id == vendor_id:
-                        # Возвращаем путь к директории устройства
-                        device_path = vendor_file.replace('/idVendor', '')
-                        auth_file = f"{device_path}/authorized"
-
-                        logger.info(f"Found potential device path: {device_path}")
-
-                        # Проверяем, что файл authorized существует
-                        if await self._file_exists(auth_file):
-                            logger.info(f"✅ Valid device path found: {device_path}")
-                            return device_path
-                        else:
-                            logger.warning(f"Authorized file not found: {auth_file}")
-
-                except Exception as e:
-                    logger.debug(f"Error reading vendor file {vendor_file}: {e}")
-                    continue
-
-            # Метод 2: Альтернативный поиск через lsusb и /sys/bus/usb/devices
-            logger.info("Trying alternative method using lsusb...")
-
-            # Получаем Bus и Device из lsusb
-            result = await asyncio.create_subprocess_exec(
-                'lsusb',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode == 0:
-                lsusb_output = stdout.decode()
-
-                # Ищем строку с нужным vendor_id
-                for line in lsusb_output.split('\n'):
-                    if vendor_id in line:
-                        # Парсим строку: Bus 001 Device 011: ID 12d1:1f01 Huawei Technologies Co., Ltd.
-                        bus_match = re.search(r'Bus (\d+) Device (\d+)', line)
-                        if bus_match:
-                            bus_num = bus_match.group(1)
-                            dev_num = bus_match.group(2)
-
-                            # Формируем возможные пути
-                            possible_paths = [
-                                f"/sys/bus/usb/devices/{bus_num}-{dev_num}",
-                                f"/sys/bus/usb/devices/{bus_num}-{dev_num}.1",
-                                f"/sys/bus/usb/devices/{bus_num}-{dev_num}.2",
-                                f"/sys/bus/usb/devices/usb{bus_num}",
-                            ]
-
-                            # Попробуем найти все возможные пути для этого устройства
-                            for i in range(1, 20):  # Попробуем разные варианты
-                                for suffix in ['', '.1', '.2', '.3', '.4']:
-                                    path = f"/sys/bus/usb/devices/{bus_num}-{i}{suffix}"
-                                    auth_file = f"{path}/authorized"
-
-                                    if await self._file_exists(auth_file):
-                                        # Проверяем, что это наше устройство
-                                        vendor_file = f"{path}/idVendor"
-                                        if await self._file_exists(vendor_file):
-                                            try:
-                                                with open(vendor_file, 'r') as f:
-                                                    found_vendor = f.read().strip()
-                                                if found_vendor == vendor_id:
-                                                    logger.info(f"✅ Found device via alternative method: {path}")
-                                                    return path
-                                            except:
-                                                continue
-
-            # Метод 3: Прямой поиск в /sys/bus/usb/devices
-            logger.info("Trying direct search in /sys/bus/usb/devices...")
-
-            try:
-                import os
-                for device_name in os.listdir('/sys/bus/usb/devices'):
-                    device_path = f"/sys/bus/usb/devices/{device_name}"
-                    vendor_file = f"{device_path}/idVendor"
-                    auth_file = f"{device_path}/authorized"
-
-                    if os.path.exists(vendor_file) and os.path.exists(auth_file):
-                        try:
-                            with open(vendor_file, 'r') as f:
-                                found_vendor = f.read().strip()
-                            if found_vendor == vendor_id:
-                                logger.info(f"✅ Found device via direct search: {device_path}")
-                                return device_path
-                        except:
-                            continue
-            except Exception as e:
-                logger.error(f"Error in direct search: {e}")
+            # Просмотр idVendor файлов в /sys/bus/usb/devices
+            device_path = await asyncio.to_thread(self._scan_sysfs_vendor, vendor_id)
+            if device_path:
+                logger.info(f"✅ Valid device path found: {device_path}")
+                return device_path
 
             logger.error(f"Could not find sysfs path for vendor ID: {vendor_id}")
             return None
@@ -586,16 +568,41 @@ class EnhancedRotationManager:
             logger.error(f"Error finding USB device path: {e}")
             return None
 
+    @staticmethod
+    def _usb_device_path_for_interface(interface: str, vendor_id: str) -> Optional[str]:
+        """sysfs путь USB устройства, которому принадлежит сетевой интерфейс (с проверкой vendor ID)"""
+        # device указывает на USB интерфейс (например 1-1.2:1.0), само устройство - выше по дереву
+        device_link = Path(os.path.realpath(f'/sys/class/net/{interface}/device'))
+        for candidate in (device_link, *device_link.parents):
+            vendor_file = candidate / 'idVendor'
+            if not vendor_file.is_file():
+                continue
+            try:
+                if vendor_file.read_text().strip() != vendor_id:
+                    return None
+            except OSError:
+                return None
+            return str(candidate) if (candidate / 'authorized').is_file() else None
+        return None
+
+    @staticmethod
+    def _scan_sysfs_vendor(vendor_id: str) -> Optional[str]:
+        """Поиск в sysfs устройства с заданным vendor ID и файлом authorized"""
+        for vendor_file in Path('/sys/bus/usb/devices').glob('*/idVendor'):
+            try:
+                if vendor_file.read_text().strip() != vendor_id:
+                    continue
+            except OSError:
+                continue
+
+            if (vendor_file.parent / 'authorized').is_file():
+                return str(vendor_file.parent)
+        return None
+
     async def _file_exists(self, file_path: str) -> bool:
         """Проверка существования файла"""
         try:
-            result = await asyncio.create_subprocess_exec(
-                'test', '-f', file_path,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
-            return result.returncode == 0
+            return await asyncio.to_thread(os.path.isfile, file_path)
         except Exception:
             return False
 
@@ -611,61 +618,27 @@ class EnhancedRotationManager:
             modem_ip = await self._find_modem_ip(interface)
             if not modem_ip:
                 logger.warning("Could not find modem IP for monitoring")
-                # Просто ждем фиксированное время
-                await asyncio.sleep(5)
+                # Ждем появления IP на интерфейсе, но не дольше прежней паузы
+                await self._wait_for_interface_ip(interface, timeout=5)
                 return True, "Monitoring skipped - modem IP not found"
 
             logger.info(f"Monitoring modem IP: {modem_ip}")
 
             # Мониторинг отключения (15 секунд максимум)
-            disconnected = False
-            for i in range(15):
-                try:
-                    result = await asyncio.create_subprocess_exec(
-                        'timeout', '2', 'ping', '-c', '1', '-W', '1', modem_ip,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    await result.communicate()
-
-                    if result.returncode != 0:
-                        logger.info(f"Modem disconnected after {i + 1} seconds")
-                        disconnected = True
-                        break
-
-                except Exception:
-                    disconnected = True
-                    break
-
-                await asyncio.sleep(1)
-
-            if not disconnected:
+            elapsed = await self._wait_for_modem_state(modem_ip, reachable=False, timeout=15)
+            if elapsed is None:
                 logger.warning("Modem did not disconnect within 15 seconds")
+            else:
+                logger.info(f"Modem disconnected after {elapsed:.1f} seconds")
 
             # Мониторинг подключения (30 секунд максимум)
-            connected = False
-            for i in range(30):
-                try:
-                    result = await asyncio.create_subprocess_exec(
-                        'timeout', '2', 'ping', '-c', '1', '-W', '1', modem_ip,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    await result.communicate()
-
-                    if result.returncode == 0:
-                        logger.info(f"Modem reconnected after {i + 1} seconds")
-                        connected = True
-                        break
-
-                except Exception:
-                    pass
-
-                await asyncio.sleep(1)
-
-            if not connected:
+            elapsed = await self._wait_for_modem_state(modem_ip, reachable=True, timeout=30)
+            if elapsed is None:
+                self._modem_ip_cache.pop(interface, None)
                 return False, "Modem did not reconnect within 30 seconds"
 
+            logger.info(f"Modem reconnected after {elapsed:.1f} seconds")
+
             # Пауза для стабилизации соединения
             await asyncio.sleep(5)
 
@@ -675,27 +648,105 @@ class EnhancedRotationManager:
             logger.error(f"Error during USB reboot monitoring: {e}")
             return False, f"Monitoring error: {str(e)}"
 
+    async def _probe_modem(self, modem_ip: str, timeout: float = 1.0) -> bool:
+        """Проверка доступности модема: ICMP echo, при недоступности ICMP сокетов - TCP подключение"""
+        icmp_result = await self._icmp_echo(modem_ip, timeout)
+        if icmp_result is not None:
+            return icmp_result
+
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(modem_ip, 80), timeout=timeout)
+        except ConnectionRefusedError:
+            # Модем ответил RST - он в сети, просто порт закрыт
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    async def _icmp_echo(self, modem_ip: str, timeout: float) -> Optional[bool]:
+        """ICMP echo через непривилегированный сокет, None если такие сокеты недоступны"""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except OSError:
+            # net.ipv4.ping_group_range не разрешает ICMP сокеты для процесса
+            return None
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            sock.setblocking(False)
+            # Echo request; идентификатор и контрольную сумму заполняет ядро
+            sock.sendto(struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, 1), (modem_ip, 0))
+
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+
+                data = await asyncio.wait_for(loop.sock_recv(sock, 1024), remaining)
+                if data and data[0] == ICMP_ECHO_REPLY:
+                    return True
+
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            sock.close()
+
+    async def _wait_for_modem_state(self, modem_ip: str, reachable: bool, timeout: float,
+                                    interval: float = 0.5) -> Optional[float]:
+        """Ожидание нужного состояния модема, возвращает затраченное время или None по таймауту"""
+        start = time.monotonic()
+        deadline = start + timeout
+        while time.monotonic() < deadline:
+            if await self._probe_modem(modem_ip) == reachable:
+                return time.monotonic() - start
+            await asyncio.sleep(interval)
+        return None
+
+    async def _wait_for_interface_ip(self, interface: str, timeout: float, interval: float = 0.5) -> bool:
+        """Ожидание IPv4 адреса на интерфейсе (не дольше timeout секунд)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if netifaces.AF_INET in netifaces.ifaddresses(interface):
+                    return True
+            except (OSError, ValueError):
+                # Интерфейс еще не появился после перезагрузки
+                pass
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(interval, remaining))
+
     async def _find_modem_ip(self, interface: str) -> Optional[str]:
         """Поиск IP модема через маршруты"""
+        cached = self._modem_ip_cache.get(interface)
+        if cached and time.monotonic() - cached[1] < MODEM_IP_CACHE_TTL:
+            return cached[0]
+
         try:
             # Получаем маршруты для интерфейса
-            result = await asyncio.create_subprocess_exec(
-                'ip', 'route', 'list', 'dev', interface,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
+            returncode, stdout, stderr = await self._run('ip', 'route', 'list', 'dev', interface)
 
-            if result.returncode != 0:
+            if returncode != 0:
                 return None
 
             # Ищем default gateway
             routes = stdout.decode()
             for line in routes.split('\n'):
                 if 'via' in line:
-                    match = re.search(r'via (\d+\.\d+\.\d+\.\d+)', line)
+                    match = _RE_ROUTE_VIA.search(line)
                     if match:
-                        return match.group(1)
+                        modem_ip = match.group(1)
+                        self._modem_ip_cache[interface] = (modem_ip, time.monotonic())
+                        return modem_ip
 
             return None
 
@@ -706,36 +757,36 @@ class EnhancedRotationManager:
     async def _get_external_ip_via_interface(self, interface: str) -> Optional[str]:
         """Получение внешнего IP через интерфейс"""
         try:
-            # Используем curl с привязкой к интерфейсу
-            result = await asyncio.create_subprocess_exec(
-                'curl', '--interface', interface, '-s', '--connect-timeout', '8',
-                'https://2ip.ru',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode == 0:
-                output = stdout.decode().strip()
-                # Ищем IP в выводе
-                ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', output)
-                if ip_match:
-                    return ip_match.group(1)
-
-            # Резервный способ через ifconfig.me
-            result = await asyncio.create_subprocess_exec(
-                'curl', '--interface', interface, '-s', '--connect-timeout', '8',
-                'https://ifconfig.me',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
+            addresses = netifaces.ifaddresses(interface)
+            if netifaces.AF_INET not in addresses:
+                logger.warning("No IPv4 address on interface", interface=interface)
+                return None
 
-            if result.returncode == 0:
-                output = stdout.decode().strip()
-                ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', output)
-                if ip_match:
-                    return ip_match.group(1)
+            local_ip = addresses[netifaces.AF_INET][0]['addr']
+
+            # Привязываемся к IP интерфейса, ответ с curl User-Agent - просто IP
+            connector = aiohttp.TCPConnector(local_addr=(local_ip, 0))
+            async with aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=15, connect=8),
+                headers={'User-Agent': 'curl/8.0'}
+            ) as session:
+                # Берем первый успешный ответ от любого из сервисов
+                pending = {
+                    asyncio.create_task(self._fetch_external_ip(session, url))
+                    for url in self._EXTERNAL_IP_SERVICES
+                }
+                try:
+                    while pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            external_ip = task.result()
+                            if external_ip:
+                                return external_ip
+                finally:
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
 
             return None
 
@@ -743,50 +794,95 @@ class EnhancedRotationManager:
             logger.error(f"Error getting external IP via interface {interface}: {e}")
             return None
 
+    async def _fetch_external_ip(self, session: aiohttp.ClientSession, url: str) -> Optional[str]:
+        """Запрос внешнего IP у одного сервиса"""
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                output = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug("External IP service request failed", url=url, error=str(e))
+            return None
+
+        ip_match = _RE_IPV4.search(output)
+        return ip_match.group(1) if ip_match else None
+
     # Остальные методы без изменений...
     async def _rotate_android_device(self, device: ProxyDevice, method: str) -> Tuple[bool, str]:
         """Ротация IP для Android устройства"""
         adb_id = device.name
 
+        handler_name = self._ANDROID_ROTATIONS.get(method)
+        if not handler_name:
+            return False, f"Unknown Android rotation method: {method}"
+
         try:
-            if method == 'data_toggle':
-                return await self._android_data_toggle(adb_id)
-            elif method == 'airplane_mode':
-                return await self._android_airplane_mode(adb_id)
-            elif method == 'usb_reconnect':
-                return await self._android_usb_reconnect(adb_id, device)
-            elif method == 'network_interface_reset':
-                return await self._android_interface_reset(adb_id, device)
-            else:
-                return False, f"Unknown Android rotation method: {method}"
+            return await getattr(self, handler_name)(adb_id, device)
         except Exception as e:
             return False, f"Android rotation error: {str(e)}"
 
-    async def _android_data_toggle(self, adb_id: str) -> Tuple[bool, str]:
+    async def _adb_run(self, adb_id: str, command: str, timeout: float = 15.0) -> Tuple[int, str]:
+        """Выполнение команды в постоянной adb shell сессии устройства"""
+        proc = self._adb_shells.get(adb_id)
+        if proc is None or proc.returncode is not None:
+            proc = await asyncio.create_subprocess_exec(
+                'adb', '-s', adb_id, 'shell',
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            self._adb_shells[adb_id] = proc
+
+        try:
+            # Маркер всегда с новой строки - вывод команды может не заканчиваться переводом строки
+            proc.stdin.write(f"{command}; __rc=$?; printf '\\n%s:%d\\n' {ADB_END_MARKER} $__rc\n".encode())
+            await proc.stdin.drain()
+
+            output = []
+            while True:
+                line = await asyncio.wait_for(proc.stdout.readline(), timeout)
+                if not line:
+                    raise ConnectionError(f"adb shell for {adb_id} closed")
+
+                text = line.decode(errors='replace').rstrip('\r\n')
+                if text.startswith(f"{ADB_END_MARKER}:"):
+                    # Пустая строка перед маркером - наш перевод строки, а не вывод команды
+                    if output and not output[-1]:
+                        output.pop()
+                    return int(text[len(ADB_END_MARKER) + 1:]), '\n'.join(output)
+                output.append(text)
+
+        except Exception:
+            # Сессия в неизвестном состоянии - следующий вызов откроет новую
+            await self._close_adb_shell(adb_id)
+            raise
+
+    async def _close_adb_shell(self, adb_id: str):
+        """Закрытие постоянной adb shell сессии"""
+        proc = self._adb_shells.pop(adb_id, None)
+        if proc is None or proc.returncode is not None:
+            return
+
+        try:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            pass
+
+    async def _android_data_toggle(self, adb_id: str, device: ProxyDevice) -> Tuple[bool, str]:
         """Переключение мобильных данных на Android"""
         try:
             # Отключение мобильных данных
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'svc', 'data', 'disable',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode != 0:
-                return False, f"Failed to disable data: {stderr.decode()}"
+            returncode, output = await self._adb_run(adb_id, 'svc data disable')
+            if returncode != 0:
+                return False, f"Failed to disable data: {output}"
 
             # Ожидание отключения
             await asyncio.sleep(3)
 
             # Включение мобильных данных
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'svc', 'data', 'enable',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode != 0:
-                return False, f"Failed to enable data: {stderr.decode()}"
+            returncode, output = await self._adb_run(adb_id, 'svc data enable')
+            if returncode != 0:
+                return False, f"Failed to enable data: {output}"
 
             # Ожидание восстановления соединения
             await asyncio.sleep(10)
@@ -796,41 +892,25 @@ class EnhancedRotationManager:
         except Exception as e:
             return False, f"Data toggle error: {str(e)}"
 
-    async def _android_airplane_mode(self, adb_id: str) -> Tuple[bool, str]:
+    async def _android_airplane_mode(self, adb_id: str, device: ProxyDevice) -> Tuple[bool, str]:
         """Режим полета на Android"""
         try:
-            # Включение режима полета
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'settings', 'put', 'global', 'airplane_mode_on', '1',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            # Включение режима полета и применение настроек одной командой
+            await self._adb_run(
+                adb_id,
+                'settings put global airplane_mode_on 1; '
+                'am broadcast -a android.intent.action.AIRPLANE_MODE --ez state true'
             )
-            await result.communicate()
-
-            # Применение настроек
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'am', 'broadcast',
-                '-a', 'android.intent.action.AIRPLANE_MODE', '--ez', 'state', 'true',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            await result.communicate()
 
             # Ожидание
             await asyncio.sleep(5)
 
-            # Отключение режима полета
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'settings', 'put', 'global', 'airplane_mode_on', '0',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            await result.communicate()
-
-            # Применение настроек
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'am', 'broadcast',
-                '-a', 'android.intent.action.AIRPLANE_MODE', '--ez', 'state', 'false',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            # Отключение режима полета и применение настроек
+            await self._adb_run(
+                adb_id,
+                'settings put global airplane_mode_on 0; '
+                'am broadcast -a android.intent.action.AIRPLANE_MODE --ez state false'
             )
-            await result.communicate()
 
             # Ожидание восстановления
             await asyncio.sleep(15)
@@ -843,21 +923,22 @@ class EnhancedRotationManager:
     async def _android_usb_reconnect(self, adb_id: str, device: ProxyDevice) -> Tuple[bool, str]:
         """Переподключение USB tethering на Android"""
         try:
-            # Отключение USB tethering
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'svc', 'usb', 'setFunctions', 'none',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            await result.communicate()
+            # Отключение USB tethering - adb соединение при этом обрывается,
+            # поэтому ответа не ждем, а сессию открываем заново
+            try:
+                await self._adb_run(adb_id, 'svc usb setFunctions none', timeout=5)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            await self._close_adb_shell(adb_id)
 
             await asyncio.sleep(3)
 
             # Включение USB tethering
-            result = await asyncio.create_subprocess_exec(
-                'adb', '-s', adb_id, 'shell', 'svc', 'usb', 'setFunctions', 'rndis',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            await result.communicate()
+            try:
+                await self._adb_run(adb_id, 'svc usb setFunctions rndis', timeout=5)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            await self._close_adb_shell(adb_id)
 
             await asyncio.sleep(8)
 
@@ -875,164 +956,237 @@ class EnhancedRotationManager:
 
             # Если нет в БД, получаем напрямую
             return await self._force_refresh_device_external_ip(device)
-        except Exception as e:
-            logger.error(f"Error getting current device IP: {e}")
+        except Exception:
+            logger.exception("Error getting current device IP", device_name=device.name)
             return None
 
     async def _force_refresh_device_external_ip(self, device: ProxyDevice) -> Optional[str]:
         """Принудительное обновление внешнего IP устройства"""
         try:
-            device_name = device.name
-            device_type = device.device_type
-
-            # Получаем внешний IP в зависимости от типа устройства
-            if device_type == 'android':
-                if self.device_manager:
-                    android_device = await self.device_manager.get_device_by_id(device_name)
-                    if android_device:
-                        android_device.pop('external_ip', None)
-                    return await self.device_manager.get_device_external_ip(device_name)
-
-            elif device_type == 'usb_modem':
-                if hasattr(self, 'modem_manager') and self.modem_manager:
-                    return await self.modem_manager.force_refresh_external_ip(device_name)
-
-            return await self._get_device_external_ip_by_uuid(str(device.id))
+            return await self._refresh_external_ip(device.device_type, device.name)
 
-        except Exception as e:
-            logger.error(f"Error force refreshing external IP for device {device.name}: {e}")
+        except Exception:
+            logger.exception("Error force refreshing external IP", device_name=device.name)
             return None
 
     async def _verify_ip_change(self, device: ProxyDevice, old_ip: str, max_attempts: int = 5) -> Optional[str]:
         """Улучшенная проверка изменения IP адреса устройства"""
-        logger.info(f"Verifying IP change for device {device.name}, old IP: {old_ip}")
+        logger.info("Verifying IP change", device_name=device.name, old_ip=old_ip)
+
+        # Интерфейс модема - паузы между попытками прерываются при смене его адреса
+        interface = await self._get_modem_interface(device.name)
 
         for attempt in range(max_attempts):
+            # Экспоненциальная пауза между попытками: 0.5, 1, 2, 4, 8 секунд
+            delay = min(8, 0.5 * (2 ** attempt))
+
             try:
                 # Принудительно обновляем IP из менеджера
                 new_ip = await self._force_refresh_device_external_ip(device)
 
                 if new_ip:
-                    logger.debug(f"Attempt {attempt + 1}: Got IP {new_ip} for device {device.name}")
+                    logger.debug("Got IP", device_name=device.name, ip=new_ip, attempt=attempt + 1)
 
                     # Проверяем изменение IP
                     if new_ip != old_ip:
-                        logger.info(f"✅ IP changed from {old_ip} to {new_ip} for device {device.name}")
+                        logger.info("IP changed", device_name=device.name, old_ip=old_ip, new_ip=new_ip)
                         return new_ip
                     else:
-                        logger.debug(f"IP unchanged: {new_ip} (attempt {attempt + 1}/{max_attempts})")
+                        logger.debug("IP unchanged", device_name=device.name, ip=new_ip, attempt=attempt + 1,
+                                     max_attempts=max_attempts)
 
                         # Для некоторых операторов IP может не изменяться сразу
-                        if attempt >= 2:
-                            await asyncio.sleep(8)
-                        else:
-                            await asyncio.sleep(3)
+                        await self._wait_for_address_change(interface, delay)
                 else:
-                    logger.warning(f"Could not get IP on attempt {attempt + 1} for device {device.name}")
-                    await asyncio.sleep(3)
+                    logger.warning("Could not get IP", device_name=device.name, attempt=attempt + 1)
+                    await self._wait_for_address_change(interface, delay)
 
             except Exception as e:
-                logger.warning(f"IP check attempt {attempt + 1} failed: {e}")
-                await asyncio.sleep(3)
+                logger.warning("IP check attempt failed", device_name=device.name, attempt=attempt + 1, error=str(e))
+                await self._wait_for_address_change(interface, delay)
 
         # Если IP не изменился, возвращаем текущий IP
-        logger.info(f"IP didn't change after {max_attempts} attempts for device {device.name}")
+        logger.info("IP didn't change", device_name=device.name, attempts=max_attempts)
 
         if old_ip and old_ip != "None":
-            logger.info(f"Returning current IP {old_ip} as rotation result")
+            logger.info("Returning current IP as rotation result", device_name=device.name, ip=old_ip)
             return old_ip
 
         return None
 
+    async def _wait_for_address_change(self, interface: Optional[str], timeout: float) -> bool:
+        """Ожидание назначения IPv4 адреса интерфейсу через netlink (не дольше timeout секунд)"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        if not interface:
+            await asyncio.sleep(timeout)
+            return False
+
+        try:
+            ifindex = socket.if_nametoindex(interface)
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        except OSError:
+            # Подписка недоступна - обычная пауза
+            await asyncio.sleep(timeout)
+            return False
+
+        try:
+            sock.setblocking(False)
+            sock.bind((0, RTMGRP_IPV4_IFADDR))
+
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+
+                try:
+                    data = await asyncio.wait_for(loop.sock_recv(sock, 65536), remaining)
+                except asyncio.TimeoutError:
+                    return False
+
+                # nlmsghdr (16 байт) + ifaddrmsg, индекс интерфейса по смещению 20
+                offset = 0
+                while offset + 24 <= len(data):
+                    msg_len, msg_type = struct.unpack_from('=IH', data, offset)
+                    if msg_type == RTM_NEWADDR and struct.unpack_from('=I', data, offset + 20)[0] == ifindex:
+                        return True
+                    if msg_len < 16:
+                        break
+                    offset += (msg_len + 3) & ~3
+
+        except OSError as e:
+            logger.debug("Netlink address wait failed", interface=interface, error=str(e))
+            remaining = deadline - loop.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            return False
+        finally:
+            sock.close()
+
     def _get_stabilization_delay(self, device_type: str) -> int:
         """Получение времени стабилизации в зависимости от типа устройства"""
-        delays = {
-            'android': 8,
-            'usb_modem': 10,  # Увеличено для USB перезагрузки
-            'raspberry_pi': 15,
-            'network_device': 5
-        }
-        return delays.get(device_type, 10)
-
-    async def _create_default_rotation_config(self, device: ProxyDevice) -> RotationConfig:
-        """Создание конфигурации ротации по умолчанию"""
-        default_methods = {
-            'android': 'data_toggle',
-            'usb_modem': 'usb_reboot',  # Единственный метод для USB модемов
-            'raspberry_pi': 'ppp_restart',
-            'network_device': 'interface_restart'
-        }
+        return STABILIZATION_DELAYS.get(device_type, 10)
 
-        method = default_methods.get(device.device_type, 'data_toggle')
+    async def _create_default_rotation_config(self, device: ProxyDevice,
+                                              db: Optional[AsyncSession] = None) -> RotationConfig:
+        """Создание конфигурации ротации по умолчанию (commit - на вызывающем, если передана сессия)"""
+        if db is None:
+            async with AsyncSessionLocal() as db:
+                config = await self._create_default_rotation_config(device, db)
+                await db.commit()
+            return config
 
-        config = RotationConfig(
+        method = DEFAULT_ROTATION_METHODS.get(device.device_type, 'data_toggle')
+
+        # INSERT ... RETURNING - серверные значения по умолчанию без отдельного SELECT
+        stmt = insert(RotationConfig).values(
             device_id=device.id,
             rotation_method=method,
             rotation_interval=600,
             auto_rotation=True
-        )
+        ).returning(RotationConfig)
 
-        async with AsyncSessionLocal() as db:
-            db.add(config)
-            await db.commit()
-            await db.refresh(config)
+        result = await db.execute(stmt)
+        return result.scalar_one()
 
-        return config
-
-    async def _update_device_ip(self, device_id: str, new_ip: str):
-        """Обновление IP адреса устройства в базе данных"""
+    async def _save_rotation_result(self, device_uuid: uuid.UUID, new_ip: Optional[str] = None,
+                                    stored_ip: Optional[str] = None):
+        """Сохранение результата ротации в базе данных одной транзакцией"""
+        now = datetime.now()
         try:
             async with AsyncSessionLocal() as db:
-                device_uuid = uuid.UUID(device_id)
-                now = datetime.now()
-
-                stmt = update(ProxyDevice).where(
-                    ProxyDevice.id == device_uuid
-                ).values(
-                    current_external_ip=new_ip,
-                    updated_at=now
-                )
-                await db.execute(stmt)
+                await self._update_device_rotation(db, device_uuid, now, new_ip, stored_ip)
+                if new_ip:
+                    await self._save_ip_history(device_uuid, new_ip, now, db)
                 await db.commit()
-        except Exception as e:
-            logger.error(f"Error updating device IP: {e}")
+        except Exception:
+            logger.exception("Error saving rotation result", device_id=str(device_uuid))
+
+    async def _update_device_rotation(self, db: AsyncSession, device_uuid: uuid.UUID, now: datetime,
+                                      new_ip: Optional[str] = None, stored_ip: Optional[str] = None):
+        """Обновление времени ротации и, если изменился, IP адреса устройства одним UPDATE"""
+        # IP и updated_at пишем только при реальной смене относительно сохраненного в БД значения
+        if new_ip and new_ip != stored_ip:
+            await db.execute(_UPD_DEVICE_ROTATION_IP, {'b_id': device_uuid, 'b_now': now, 'b_ip': new_ip})
+        else:
+            await db.execute(_UPD_DEVICE_ROTATION, {'b_id': device_uuid, 'b_now': now})
+
+    async def _save_ip_history(self, device_uuid: uuid.UUID, ip_address: str, now: Optional[datetime] = None,
+                               db: Optional[AsyncSession] = None):
+        """Сохранение IP адреса в историю: в сессии вызывающего (его транзакцией), иначе через очередь фоновой записи"""
+        now = now or datetime.now()
+        row = {
+            'device_id': device_uuid,
+            'ip_address': ip_address,
+            'first_seen': now,
+            'last_seen': now,
+            'total_requests': 1
+        }
 
-    async def _save_ip_history(self, device_id: str, ip_address: str):
-        """Сохранение IP адреса в историю"""
-        try:
-            async with AsyncSessionLocal() as db:
-                device_uuid = uuid.UUID(device_id)
-                now = datetime.now()
-
-                ip_history = IpHistory(
-                    device_id=device_uuid,
-                    ip_address=ip_address,
-                    first_seen=now,
-                    last_seen=now,
-                    total_requests=1
-                )
-                db.add(ip_history)
-                await db.commit()
-        except Exception as e:
-            logger.error(f"Error saving IP history: {e}")
+        if db is not None or self._ip_history_flusher_task is None or self._ip_history_flusher_task.done():
+            # Передана сессия - запись входит в транзакцию вызывающего;
+            # фоновая запись не запущена - пишем сразу в своей сессии
+            await self._write_ip_history([row], db)
+        else:
+            self._ip_history_queue.put_nowait(row)
+
+    async def _ip_history_flusher(self):
+        """Фоновая запись истории IP пачками"""
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = [await self._ip_history_queue.get()]
+            try:
+                # Набираем пачку, но ждем не дольше IP_HISTORY_FLUSH_INTERVAL
+                deadline = loop.time() + IP_HISTORY_FLUSH_INTERVAL
+                while len(rows) < IP_HISTORY_BATCH_SIZE:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        rows.append(await asyncio.wait_for(self._ip_history_queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                # Набранные записи сохраняем и при остановке задачи
+                await self._write_ip_history(rows)
+
+    @staticmethod
+    def _ip_history_upsert(rows: List[Dict[str, Any]]):
+        """INSERT ... ON CONFLICT (device_id, ip_address) DO UPDATE для пачки записей истории IP"""
+        # Одна пара (device_id, ip_address) может встретиться в одном INSERT только раз
+        merged: Dict[Tuple[uuid.UUID, str], Dict[str, Any]] = {}
+        for row in rows:
+            key = (row['device_id'], row['ip_address'])
+            seen = merged.get(key)
+            if seen is None:
+                merged[key] = dict(row)
+            else:
+                seen['first_seen'] = min(seen['first_seen'], row['first_seen'])
+                seen['last_seen'] = max(seen['last_seen'], row['last_seen'])
+                seen['total_requests'] += row['total_requests']
+
+        stmt = pg_insert(IpHistory).values(list(merged.values()))
+        return stmt.on_conflict_do_update(
+            index_elements=[IpHistory.device_id, IpHistory.ip_address],
+            set_={
+                'last_seen': stmt.excluded.last_seen,
+                'total_requests': IpHistory.total_requests + stmt.excluded.total_requests
+            }
+        )
+
+    async def _write_ip_history(self, rows: List[Dict[str, Any]], db: Optional[AsyncSession] = None):
+        """Запись пачки записей истории IP одним запросом (commit - на вызывающем, если передана сессия)"""
+        if db is not None:
+            await db.execute(self._ip_history_upsert(rows))
+            return
 
-    async def _update_rotation_stats(self, device_id: str, success: bool):
-        """Обновление статистики ротации"""
         try:
             async with AsyncSessionLocal() as db:
-                device_uuid = uuid.UUID(device_id)
-                now = datetime.now()
-
-                stmt = update(ProxyDevice).where(
-                    ProxyDevice.id == device_uuid
-                ).values(
-                    last_ip_rotation=now,
-                    updated_at=now
-                )
-                await db.execute(stmt)
+                await db.execute(self._ip_history_upsert(rows))
                 await db.commit()
         except Exception as e:
-            logger.error(f"Error updating rotation stats: {e}")
+            logger.error("Error saving IP history", rows=len(rows), error=str(e))
 
     async def stop(self):
         """Остановка менеджера ротации"""
@@ -1042,58 +1196,55 @@ class EnhancedRotationManager:
         self._running = False
         logger.info("Stopping enhanced rotation manager")
 
-        # Остановка всех задач ротации
-        for device_id, task in self.rotation_tasks.items():
+        # Остановка всех задач ротации и фоновой записи истории IP
+        tasks = list(self.rotation_tasks.values())
+        if self._ip_history_flusher_task:
+            tasks.append(self._ip_history_flusher_task)
+
+        for task in tasks:
             if not task.done():
                 task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
+        await asyncio.gather(*tasks, return_exceptions=True)
 
         self.rotation_tasks.clear()
-        self.rotation_in_progress.clear()
+        # Удаляем только свободные блокировки - удерживаемые нужны еще идущим ротациям,
+        # иначе новый вызов получил бы другую блокировку и запустил параллельную ротацию
+        for device_id in [device_id for device_id, lock in self._device_locks.items() if not lock.locked()]:
+            del self._device_locks[device_id]
+        self._ip_history_flusher_task = None
+
+        # Запись оставшихся в очереди строк истории IP
+        rows = []
+        while not self._ip_history_queue.empty():
+            rows.append(self._ip_history_queue.get_nowait())
+        if rows:
+            await self._write_ip_history(rows)
+
+        await asyncio.gather(*(self._close_adb_shell(adb_id) for adb_id in list(self._adb_shells)))
 
     async def start_all_rotation_tasks(self):
         """Запуск задач ротации для всех активных устройств"""
         pass
 
-    async def _monitor_rotation_tasks(self):
-        """Мониторинг состояния задач ротации"""
-        pass
-
-    async def _get_device_external_ip_by_uuid(self, device_uuid: str) -> Optional[str]:
-        """Получение внешнего IP устройства по UUID"""
-        try:
-            async with AsyncSessionLocal() as db:
-                stmt = select(ProxyDevice.name, ProxyDevice.device_type).where(
-                    ProxyDevice.id == uuid.UUID(device_uuid)
-                )
-                result = await db.execute(stmt)
-                row = result.first()
-
-                if not row:
-                    return None
-
-                device_name, device_type = row
-
-            # Получаем внешний IP из соответствующего менеджера
-            if device_type == 'android':
-                if self.device_manager:
-                    android_device = await self.device_manager.get_device_by_id(device_name)
-                    if android_device:
-                        android_device.pop('external_ip', None)
-                    return await self.device_manager.get_device_external_ip(device_name)
-
-            elif device_type == 'usb_modem':
-                if hasattr(self, 'modem_manager') and self.modem_manager:
-                    return await self.modem_manager.force_refresh_external_ip(device_name)
+    async def _refresh_external_ip(self, device_type: str, device_name: str) -> Optional[str]:
+        """Обновление внешнего IP через менеджер, отвечающий за тип устройства"""
+        refresher = self._EXTERNAL_IP_REFRESHERS.get(device_type)
+        if not refresher:
+            return None
+        return await getattr(self, refresher)(device_name)
 
+    async def _refresh_android_external_ip(self, device_name: str) -> Optional[str]:
+        """Обновление внешнего IP Android устройства"""
+        if not self.device_manager:
             return None
+        # DeviceManager не кэширует внешний IP - каждый вызов запрашивает его заново
+        return await self.device_manager.get_device_external_ip(device_name)
 
-        except Exception as e:
-            logger.error(f"Error getting device external IP by UUID: {e}")
+    async def _refresh_usb_modem_external_ip(self, device_name: str) -> Optional[str]:
+        """Обновление внешнего IP USB модема"""
+        if not self.modem_manager:
             return None
+        return await self.modem_manager.force_refresh_external_ip(device_name)
 
     # Заглушки для остальных методов
     async def _rotate_raspberry_pi(self, device: ProxyDevice, method: str) -> Tuple[bool, str]:
@@ -1115,42 +1266,29 @@ class EnhancedRotationManager:
             logger.info(f"🔍 Debug USB device structure for vendor ID: {vendor_id}")
 
             # 1. Показать все USB устройства
-            result = await asyncio.create_subprocess_exec(
-                'lsusb',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
+            returncode, stdout, stderr = await self._run('lsusb')
 
-            if result.returncode == 0:
+            if returncode == 0:
                 logger.info("📋 All USB devices:")
                 for line in stdout.decode().split('\n'):
                     if line.strip():
                         logger.info(f"  {line}")
 
             # 2. Показать структуру /sys/bus/usb/devices
-            result = await asyncio.create_subprocess_exec(
-                'ls', '-la', '/sys/bus/usb/devices/',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
+            returncode, stdout, stderr = await self._run('ls', '-la', '/sys/bus/usb/devices/')
 
-            if result.returncode == 0:
+            if returncode == 0:
                 logger.info("📁 /sys/bus/usb/devices/ structure:")
                 for line in stdout.decode().split('\n'):
                     if line.strip():
                         logger.info(f"  {line}")
 
             # 3. Поиск устройств с нужным vendor_id
-            result = await asyncio.create_subprocess_exec(
-                'find', '/sys/bus/usb/devices/', '-name', 'idVendor', '-exec', 'grep', '-l', vendor_id, '{}', ';',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+            returncode, stdout, stderr = await self._run(
+                'find', '/sys/bus/usb/devices/', '-name', 'idVendor', '-exec', 'grep', '-l', vendor_id, '{}', ';'
             )
-            stdout, stderr = await result.communicate()
 
-            if result.returncode == 0:
+            if returncode == 0:
                 logger.info(f"🔍 Files with vendor ID {vendor_id}:")
                 for line in stdout.decode().split('\n'):
                     if line.strip():
@@ -1161,7 +1299,6 @@ class EnhancedRotationManager:
                         logger.info(f"    Exists: {await self._file_exists(auth_file)}")
 
             # 4. Попробуем найти по другому пути
-            import os
             if os.path.exists('/sys/bus/usb/devices'):
                 logger.info("🔍 Manual search in /sys/bus/usb/devices:")
                 for device_name in os.listdir('/sys/bus/usb/devices'):
@@ -1,6 +1,6 @@
 # backend/app/core/managers.py - ОБНОВЛЕННАЯ ВЕРСИЯ С USB РОТАЦИЕЙ
 
-from typing import Optional, Any, Dict, List
+from typing import Optional, Any, Dict, List, Union, Callable, Awaitable
 
 from .dedicated_proxy_manager import DedicatedProxyManager
 from .device_manager import DeviceManager
@@ -9,7 +9,18 @@ from .proxy_server import ProxyServer
 from .enhanced_rotation_manager import EnhancedRotationManager
 import structlog
 import asyncio
+import os
+import random
+import shutil
+import time
+import uuid
 from datetime import datetime, timezone, timedelta
+from collections import defaultdict
+from itertools import chain
+from sqlalchemy import select, update, bindparam, values, column, func, String
+
+from ..models.database import AsyncSessionLocal
+from ..models.base import ProxyDevice
 
 logger = structlog.get_logger()
 
@@ -21,166 +32,276 @@ _enhanced_rotation_manager: Optional[EnhancedRotationManager] = None
 _stats_collector = None
 _managers_initialized = False
 _dedicated_proxy_manager: Optional[DedicatedProxyManager] = None
+# Блокировка инициализации/остановки менеджеров (исключает двойной запуск)
+_init_lock = asyncio.Lock()
+# Блокировки ленивого запуска отдельных менеджеров в ensure_*
+_manager_locks = {"device": asyncio.Lock(), "modem": asyncio.Lock(), "rotation": asyncio.Lock()}
+
+# Кэш поиска устройств в БД по имени: имя -> (UUID, тип, время получения)
+DEVICE_LOOKUP_CACHE_TTL = 60
+_device_lookup_cache: Dict[str, tuple[str, str, float]] = {}
+# Обратный кэш: UUID -> (имя, тип, время получения), заполняется и сбрасывается вместе с прямым
+_device_uuid_lookup_cache: Dict[str, tuple[str, str, float]] = {}
+
+# Кэш принадлежности устройства менеджеру: ID -> ("android"|"usb_modem", время получения);
+# короткий TTL - покрывает цепочку вызовов одного запроса
+DEVICE_ID_INDEX_TTL = 5
+_id_index_cache: Dict[str, tuple[str, float]] = {}
+
+# Предельное время шагов тестовой ротации (ротация / запрос внешнего IP), секунд
+TEST_ROTATION_TIMEOUT = 180
+TEST_IP_CHECK_TIMEOUT = 15
+
+# Каталог USB устройств в sysfs и USB vendor ID Huawei
+USB_SYSFS_DEVICES = '/sys/bus/usb/devices'
+HUAWEI_VENDOR_ID = '12d1'
+
+# Кэш результатов диагностических проверок системы: ключ -> (время получения, результат)
+_probe_cache: Dict[str, tuple[float, Any]] = {}
+_probe_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+# Ограничение числа одновременно запущенных диагностических команд
+MAX_CONCURRENT_PROBES = 8
+# Предельное время выполнения одной диагностической команды, секунд
+PROBE_TIMEOUT = 5
+_probe_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PROBES)
+# Сколько секунд считается актуальным результат проверки sudo без пароля
+SUDO_STATUS_TTL = 60
+# Сколько секунд диагностика и тест USB ротации переиспользуют общий снимок проверок
+USB_PROBES_TTL = 10
+
+# Готовые запросы поиска устройств (значения - через параметры)
+_STMT_UUID_TYPE_BY_NAME = select(ProxyDevice.id, ProxyDevice.device_type).where(
+    ProxyDevice.name == bindparam('name')
+)
+_STMT_NAME_TYPE_BY_UUID = select(ProxyDevice.name, ProxyDevice.device_type).where(
+    ProxyDevice.id == bindparam('id')
+)
+_STMT_IDS_TYPES_BY_NAMES = select(ProxyDevice.name, ProxyDevice.id, ProxyDevice.device_type).where(
+    ProxyDevice.name.in_(bindparam('names', expanding=True))
+)
 
 
 async def init_managers():
     """Инициализация всех менеджеров"""
-    global _device_manager, _modem_manager, _proxy_server, _dedicated_proxy_manager, _enhanced_rotation_manager, _managers_initialized
+    global _managers_initialized
 
-    try:
+    # Быстрая проверка без блокировки; повторная - под блокировкой
+    if _managers_initialized:
+        logger.info("Managers already initialized, skipping...")
+        return
+
+    async with _init_lock:
         if _managers_initialized:
             logger.info("Managers already initialized, skipping...")
             return
 
-        logger.info("Initializing managers with USB rotation support...")
-
-        # Инициализация DeviceManager (Android устройства)
-        if _device_manager is None:
-            _device_manager = DeviceManager()
-            await _device_manager.start()
-            logger.info("✅ Device manager (Android) initialized")
-
-        # Инициализация ModemManager (Huawei USB модемы)
-        if _modem_manager is None:
-            _modem_manager = ModemManager()
-            await _modem_manager.start()
-            logger.info("✅ Modem manager (Huawei) initialized")
-
-        # Инициализация Enhanced Rotation Manager с поддержкой USB ротации
-        if _enhanced_rotation_manager is None:
-            _enhanced_rotation_manager = EnhancedRotationManager()
-            _enhanced_rotation_manager.device_manager = _device_manager
-            _enhanced_rotation_manager.modem_manager = _modem_manager
-            await _enhanced_rotation_manager.start()
-            logger.info("✅ Enhanced rotation manager initialized with USB reboot support")
-
-        # Инициализация ProxyServer
-        if _proxy_server is None:
-            _proxy_server = ProxyServer(_device_manager, _stats_collector)
-            _proxy_server.modem_manager = _modem_manager
-            logger.info("✅ Proxy server initialized")
-
-        # Инициализация DedicatedProxyManager
-        if _dedicated_proxy_manager is None:
-            _dedicated_proxy_manager = DedicatedProxyManager(_device_manager)
-            _dedicated_proxy_manager.modem_manager = _modem_manager
-            await _dedicated_proxy_manager.start()
-            logger.info("✅ Dedicated proxy manager initialized")
-
-        _managers_initialized = True
-        logger.info("✅ All managers initialized successfully with USB rotation support")
+        try:
+            await _start_managers()
+            _managers_initialized = True
+            logger.info("✅ All managers initialized successfully with USB rotation support")
 
-    except Exception as e:
-        logger.error(f"❌ Error initializing managers: {e}")
-        _managers_initialized = False
-        raise
+        except Exception as e:
+            logger.error(f"❌ Error initializing managers: {e}")
+            # Откат: останавливаем уже запущенные менеджеры, чтобы повторный вызов начал с нуля
+            await _stop_managers()
+            raise
+
+
+async def _start_managers():
+    """Создание и запуск менеджеров, которые еще не запущены"""
+    global _proxy_server
+
+    logger.info("Initializing managers with USB rotation support...")
+
+    # Android устройства и Huawei USB модемы независимы - запускаем параллельно;
+    # заодно заранее проверяем sudo, чтобы первая диагностика не ждала его
+    _raise_first_error(await asyncio.gather(
+        ensure_device_manager(),
+        ensure_modem_manager(),
+        _check_sudo_access(),
+        return_exceptions=True
+    ))
+
+    # Инициализация ProxyServer
+    if _proxy_server is None:
+        _proxy_server = ProxyServer(_device_manager, _stats_collector)
+        _proxy_server.modem_manager = _modem_manager
+        logger.info("✅ Proxy server initialized")
+
+    # Менеджер ротации и индивидуальные прокси используют оба менеджера устройств
+    _raise_first_error(await asyncio.gather(
+        ensure_enhanced_rotation_manager(),
+        _start_dedicated_proxy_manager(),
+        return_exceptions=True
+    ))
+
+
+async def _start_dedicated_proxy_manager():
+    """Инициализация DedicatedProxyManager"""
+    global _dedicated_proxy_manager
+    if _dedicated_proxy_manager is None:
+        _dedicated_proxy_manager = DedicatedProxyManager(_device_manager)
+        _dedicated_proxy_manager.modem_manager = _modem_manager
+        await _dedicated_proxy_manager.start()
+        logger.info("✅ Dedicated proxy manager initialized")
+
+
+def _raise_first_error(results: List[Any]):
+    """Проброс первого исключения из результатов asyncio.gather(return_exceptions=True)"""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
 # backend/app/core/managers.py - ИСПРАВЛЕННАЯ ВЕРСИЯ ПОЛУЧЕНИЯ МЕТОДОВ РОТАЦИИ
 
+# Описания методов ротации - общие для всех ответов, не изменяются
+_USB_ROTATION_METHODS = (
+    {
+        'method': 'usb_reboot',
+        'name': 'USB перезагрузка модема (ЕДИНСТВЕННЫЙ МЕТОД)',
+        'description': 'Полная перезагрузка USB модема для смены IP - самый надежный метод для E3372h',
+        'recommended': True,
+        'risk_level': 'low',
+        'effectiveness': 'very_high',
+        'explanation': 'Отключает и включает USB устройство на уровне системы, что гарантированно меняет IP',
+        'requirements': ['sudo доступ для управления USB устройствами'],
+        'time_estimate': '30-45 секунд',
+        'success_rate': '95%+'
+    },
+)
+
+_USB_REBOOT_INFO = {
+    "title": "USB перезагрузка модема E3372h",
+    "description": "Единственный поддерживаемый метод ротации для обеспечения максимальной надежности",
+    "why_only_usb": "Для модемов E3372h USB перезагрузка является наиболее надежным методом смены IP",
+    "other_methods_disabled": "Другие методы отключены для предотвращения проблем с соединением"
+}
+
+_ANDROID_ROTATION_METHODS = (
+    {
+        'method': 'data_toggle',
+        'name': 'Переключение мобильных данных',
+        'description': 'Отключение и включение мобильных данных через ADB команды',
+        'recommended': True,
+        'risk_level': 'low'
+    },
+    {
+        'method': 'airplane_mode',
+        'name': 'Режим полета',
+        'description': 'Включение и отключение режима полета',
+        'recommended': False,
+        'risk_level': 'medium'
+    },
+    {
+        'method': 'usb_reconnect',
+        'name': 'Переподключение USB',
+        'description': 'Переподключение USB tethering',
+        'recommended': False,
+        'risk_level': 'medium'
+    },
+)
+
+
 async def _get_usb_modem_rotation_methods(device_id: str, modem_info: dict) -> dict:
     """Получение методов ротации для USB модема E3372h - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
-    rotation_methods = [
-        {
-            'method': 'usb_reboot',
-            'name': 'USB перезагрузка модема (ЕДИНСТВЕННЫЙ МЕТОД)',
-            'description': 'Полная перезагрузка USB модема для смены IP - самый надежный метод для E3372h',
-            'recommended': True,
-            'risk_level': 'low',
-            'effectiveness': 'very_high',
-            'explanation': 'Отключает и включает USB устройство на уровне системы, что гарантированно меняет IP',
-            'requirements': ['sudo доступ для управления USB устройствами'],
-            'time_estimate': '30-45 секунд',
-            'success_rate': '95%+'
-        }
-    ]
-
     return {
         "device_id": device_id,
         "device_type": "usb_modem",
         "device_mode": "e3372h",
-        "available_methods": rotation_methods,
+        "available_methods": _USB_ROTATION_METHODS,
         "current_method": 'usb_reboot',  # ВСЕГДА USB ПЕРЕЗАГРУЗКА
         "device_status": modem_info.get('status', 'unknown'),
-        "usb_reboot_info": {
-            "title": "USB перезагрузка модема E3372h",
-            "description": "Единственный поддерживаемый метод ротации для обеспечения максимальной надежности",
-            "why_only_usb": "Для модемов E3372h USB перезагрузка является наиболее надежным методом смены IP",
-            "other_methods_disabled": "Другие методы отключены для предотвращения проблем с соединением"
-        }
+        "usb_reboot_info": _USB_REBOOT_INFO
     }
 
-async def perform_device_rotation(device_id: str, method: str = None) -> tuple[bool, str]:
-    """ИСПРАВЛЕННАЯ ВЕРСИЯ с принудительным USB методом"""
-    rotation_manager = get_enhanced_rotation_manager()
-    if not rotation_manager:
-        return False, "Enhanced rotation manager not available"
-
+async def perform_device_rotation(device_id: str, method: str = None, *, device_type: Optional[str] = None,
+                                  device_uuid: Optional[str] = None) -> tuple[bool, str]:
+    """ИСПРАВЛЕННАЯ ВЕРСИЯ с принудительным USB методом (тип и UUID можно передать, если уже известны)"""
     try:
-        logger.info(f"Performing rotation for device: {device_id} with method: {method}")
+        rotation_manager = await ensure_enhanced_rotation_manager()
 
-        # Получаем UUID устройства по его имени из базы данных
-        device_uuid = await _get_device_uuid_by_name(device_id)
+        logger.info("Performing rotation", device_id=device_id, method=method)
+
+        # Получаем UUID и тип устройства по его имени из базы данных, если вызывающий их не передал
+        if not (device_uuid and device_type):
+            db_uuid, db_type = await _get_device_uuid_and_type_by_name(device_id)
+            device_uuid = device_uuid or db_uuid
+            device_type = device_type or db_type
         if not device_uuid:
-            logger.error(f"Device not found in database: {device_id}")
+            logger.error("Device not found in database", device_id=device_id)
             return False, f"Device not found in database: {device_id}"
 
         # Для USB модемов ВСЕГДА используем USB перезагрузку
-        device_type = await _get_device_type_by_name(device_id)
         if device_type == 'usb_modem':
             method = 'usb_reboot'
-            logger.info(f"USB modem detected, forcing USB reboot method for {device_id}")
+            logger.info("USB modem detected, forcing USB reboot method", device_id=device_id)
 
         # Выполняем ротацию
         success, result = await rotation_manager.rotate_device_ip(str(device_uuid), force_method=method)
 
         if success:
-            logger.info(f"✅ Rotation successful for {device_id} (UUID: {device_uuid}): {result}")
+            logger.info("✅ Rotation successful", device_id=device_id, device_uuid=device_uuid, result=result)
             return True, result
         else:
-            logger.error(f"❌ Rotation failed for {device_id} (UUID: {device_uuid}): {result}")
+            logger.error("❌ Rotation failed", device_id=device_id, device_uuid=device_uuid, result=result)
             return False, result
 
     except Exception as e:
-        logger.error(f"Error in device rotation: {e}")
+        logger.error("Error in device rotation", device_id=device_id, error=str(e))
         return False, f"Rotation error: {str(e)}"
 
-def get_device_manager() -> Optional[DeviceManager]:
-    """Получение экземпляра DeviceManager (Android устройства)"""
+async def ensure_device_manager() -> DeviceManager:
+    """Получение DeviceManager с запуском при первом обращении"""
     global _device_manager
-
     if _device_manager is None:
-        logger.info("Creating new DeviceManager instance")
-        _device_manager = DeviceManager()
+        async with _manager_locks["device"]:
+            if _device_manager is None:
+                manager = DeviceManager()
+                await manager.start()
+                _device_manager = manager
+                logger.info("✅ Device manager (Android) initialized")
+    return _device_manager
 
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                asyncio.create_task(_device_manager.start())
-            else:
-                asyncio.run(_device_manager.start())
-        except Exception as e:
-            logger.warning(f"Could not start device manager immediately: {e}")
 
+async def ensure_modem_manager() -> ModemManager:
+    """Получение ModemManager с запуском при первом обращении"""
+    global _modem_manager
+    if _modem_manager is None:
+        async with _manager_locks["modem"]:
+            if _modem_manager is None:
+                manager = ModemManager()
+                await manager.start()
+                _modem_manager = manager
+                logger.info("✅ Modem manager (Huawei) initialized")
+    return _modem_manager
+
+
+async def ensure_enhanced_rotation_manager() -> EnhancedRotationManager:
+    """Получение EnhancedRotationManager с запуском при первом обращении"""
+    global _enhanced_rotation_manager
+    if _enhanced_rotation_manager is None:
+        async with _manager_locks["rotation"]:
+            if _enhanced_rotation_manager is None:
+                manager = EnhancedRotationManager()
+                manager.device_manager = await ensure_device_manager()
+                manager.modem_manager = await ensure_modem_manager()
+                await manager.start()
+                _enhanced_rotation_manager = manager
+                logger.info("✅ Enhanced rotation manager initialized with USB reboot support")
+    return _enhanced_rotation_manager
+
+
+def get_device_manager() -> Optional[DeviceManager]:
+    """Получение экземпляра DeviceManager (Android устройства)"""
+    if _device_manager is None:
+        logger.error("DeviceManager not initialized; call init_managers() during app startup")
     return _device_manager
 
 
 def get_modem_manager() -> Optional[ModemManager]:
     """Получение экземпляра ModemManager (Huawei USB модемы)"""
-    global _modem_manager
-
     if _modem_manager is None:
-        logger.info("Creating new ModemManager instance")
-        _modem_manager = ModemManager()
-
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                asyncio.create_task(_modem_manager.start())
-            else:
-                asyncio.run(_modem_manager.start())
-        except Exception as e:
-            logger.warning(f"Could not start modem manager immediately: {e}")
-
+        logger.error("ModemManager not initialized; call init_managers() during app startup")
     return _modem_manager
 
 
@@ -196,27 +317,8 @@ def get_dedicated_proxy_manager() -> Optional[DedicatedProxyManager]:
 
 def get_enhanced_rotation_manager() -> Optional[EnhancedRotationManager]:
     """Получение экземпляра улучшенного менеджера ротации с поддержкой USB"""
-    global _enhanced_rotation_manager
-
     if _enhanced_rotation_manager is None:
-        logger.info("Creating new Enhanced Rotation Manager instance with USB support")
-        _enhanced_rotation_manager = EnhancedRotationManager()
-
-        # Связываем с менеджерами устройств если они существуют
-        if _device_manager:
-            _enhanced_rotation_manager.device_manager = _device_manager
-        if _modem_manager:
-            _enhanced_rotation_manager.modem_manager = _modem_manager
-
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                asyncio.create_task(_enhanced_rotation_manager.start())
-            else:
-                asyncio.run(_enhanced_rotation_manager.start())
-        except Exception as e:
-            logger.warning(f"Could not start enhanced rotation manager immediately: {e}")
-
+        logger.error("EnhancedRotationManager not initialized; call init_managers() during app startup")
     return _enhanced_rotation_manager
 
 
@@ -235,106 +337,106 @@ def set_rotation_manager(rotation_manager):
 
 async def cleanup_managers():
     """Очистка всех менеджеров при завершении работы"""
-    global _device_manager, _modem_manager, _proxy_server, _dedicated_proxy_manager, _enhanced_rotation_manager
+    global _managers_initialized
+
+    async with _init_lock:
+        await _stop_managers()
+        _managers_initialized = False
 
-    try:
-        if _proxy_server:
-            await _proxy_server.stop()
-            _proxy_server = None
-            logger.info("✅ Proxy server stopped")
-
-        if _enhanced_rotation_manager:
-            await _enhanced_rotation_manager.stop()
-            _enhanced_rotation_manager = None
-            logger.info("✅ Enhanced rotation manager stopped")
-
-        if _device_manager:
-            await _device_manager.stop()
-            _device_manager = None
-            logger.info("✅ Device manager stopped")
-
-        if _modem_manager:
-            await _modem_manager.stop()
-            _modem_manager = None
-            logger.info("✅ Modem manager stopped")
-
-        if _dedicated_proxy_manager:
-            await _dedicated_proxy_manager.stop()
-            _dedicated_proxy_manager = None
-            logger.info("✅ Dedicated proxy manager stopped")
 
+async def _stop_manager(name: str, manager) -> None:
+    """Остановка одного менеджера; ошибка не мешает остановке остальных"""
+    if manager is None:
+        return
+    try:
+        await manager.stop()
+        logger.info(f"✅ {name} stopped")
     except Exception as e:
-        logger.error(f"❌ Error cleaning up managers: {e}")
+        logger.error(f"❌ Error stopping {name}: {e}")
 
 
-async def _get_device_uuid_by_name(device_name: str) -> Optional[str]:
-    """Получение UUID устройства по его имени из базы данных"""
-    try:
-        from ..models.database import AsyncSessionLocal
-        from ..models.base import ProxyDevice
-        from sqlalchemy import select
+async def _stop_managers():
+    """Остановка запущенных менеджеров"""
+    global _device_manager, _modem_manager, _proxy_server, _dedicated_proxy_manager, _enhanced_rotation_manager
 
-        async with AsyncSessionLocal() as db:
-            stmt = select(ProxyDevice.id).where(ProxyDevice.name == device_name)
-            result = await db.execute(stmt)
-            device_uuid = result.scalar_one_or_none()
+    # Сначала параллельно останавливаем потребителей устройств (прокси, ротация)
+    proxy_server, rotation_manager, dedicated_proxy_manager = (
+        _proxy_server, _enhanced_rotation_manager, _dedicated_proxy_manager
+    )
+    _proxy_server = _enhanced_rotation_manager = _dedicated_proxy_manager = None
+    await asyncio.gather(
+        _stop_manager("Proxy server", proxy_server),
+        _stop_manager("Enhanced rotation manager", rotation_manager),
+        _stop_manager("Dedicated proxy manager", dedicated_proxy_manager),
+    )
 
-            if device_uuid:
-                return str(device_uuid)
-            else:
-                logger.warning(f"Device not found in database: {device_name}")
-                return None
+    # Затем параллельно сами менеджеры устройств
+    device_manager, modem_manager = _device_manager, _modem_manager
+    _device_manager = _modem_manager = None
+    await asyncio.gather(
+        _stop_manager("Device manager", device_manager),
+        _stop_manager("Modem manager", modem_manager),
+    )
 
-    except Exception as e:
-        logger.error(f"Error getting device UUID by name: {e}")
-        return None
 
+def _remember_device_lookup(device_name: str, device_uuid: str, device_type: str, now: float):
+    """Запись устройства в прямой и обратный кэши поиска"""
+    _device_lookup_cache[device_name] = (device_uuid, device_type, now)
+    _device_uuid_lookup_cache[device_uuid] = (device_name, device_type, now)
 
-async def _get_device_type_by_name(device_name: str) -> Optional[str]:
-    """Получение типа устройства по его имени из базы данных"""
-    try:
-        from ..models.database import AsyncSessionLocal
-        from ..models.base import ProxyDevice
-        from sqlalchemy import select
 
+def _clear_device_lookup_caches():
+    """Сброс кэшей поиска устройств (после изменения данных в БД)"""
+    _device_lookup_cache.clear()
+    _device_uuid_lookup_cache.clear()
+
+
+async def _get_device_uuid_and_type_by_name(device_name: str) -> tuple[Optional[str], Optional[str]]:
+    """Получение UUID и типа устройства по его имени из базы данных одним запросом"""
+    cached = _device_lookup_cache.get(device_name)
+    if cached and time.monotonic() - cached[2] < DEVICE_LOOKUP_CACHE_TTL:
+        return cached[0], cached[1]
+
+    try:
         async with AsyncSessionLocal() as db:
-            stmt = select(ProxyDevice.device_type).where(ProxyDevice.name == device_name)
-            result = await db.execute(stmt)
-            device_type = result.scalar_one_or_none()
+            result = await db.execute(_STMT_UUID_TYPE_BY_NAME, {'name': device_name})
+            row = result.one_or_none()
+
+        if row:
+            _remember_device_lookup(device_name, str(row.id), row.device_type, time.monotonic())
+            return str(row.id), row.device_type
 
-            if device_type:
-                return device_type
-            else:
-                logger.warning(f"Device type not found in database: {device_name}")
-                return None
+        logger.warning("Device not found in database", device_name=device_name)
+        return None, None
 
     except Exception as e:
-        logger.error(f"Error getting device type by name: {e}")
-        return None
+        logger.error("Error getting device UUID and type by name", device_name=device_name, error=str(e))
+        return None, None
+
+
+async def _get_device_uuid_by_name(device_name: str) -> Optional[str]:
+    """Получение UUID устройства по его имени из базы данных"""
+    device_uuid, _ = await _get_device_uuid_and_type_by_name(device_name)
+    return device_uuid
+
+
+async def _get_device_type_by_name(device_name: str) -> Optional[str]:
+    """Получение типа устройства по его имени из базы данных"""
+    _, device_type = await _get_device_uuid_and_type_by_name(device_name)
+    return device_type
 
 
 async def get_device_rotation_methods(device_id: str) -> dict:
     """Получение доступных методов ротации для устройства с поддержкой USB"""
-    device_manager = get_device_manager()
-    modem_manager = get_modem_manager()
+    try:
+        # Ищем устройство по ID в менеджерах (без копирования полных списков)
+        device_info, device_type = await _find_device_in_managers(device_id)
 
-    if not device_manager and not modem_manager:
-        return {"error": "No device managers available"}
+        if device_type == "android":
+            return await _get_android_rotation_methods(device_id, device_info)
 
-    try:
-        # Ищем устройство в DeviceManager
-        if device_manager:
-            all_devices = await device_manager.get_all_devices()
-            if device_id in all_devices:
-                device_info = all_devices[device_id]
-                return await _get_android_rotation_methods(device_id, device_info)
-
-        # Ищем устройство в ModemManager
-        if modem_manager:
-            all_modems = await modem_manager.get_all_devices()
-            if device_id in all_modems:
-                modem_info = all_modems[device_id]
-                return await _get_usb_modem_rotation_methods(device_id, modem_info)
+        if device_type == "usb_modem":
+            return await _get_usb_modem_rotation_methods(device_id, device_info)
 
         return {"error": "Device not found"}
 
@@ -345,65 +447,21 @@ async def get_device_rotation_methods(device_id: str) -> dict:
 
 async def _get_android_rotation_methods(device_id: str, device_info: dict) -> dict:
     """Получение методов ротации для Android устройства"""
-    rotation_methods = [
-        {
-            'method': 'data_toggle',
-            'name': 'Переключение мобильных данных',
-            'description': 'Отключение и включение мобильных данных через ADB команды',
-            'recommended': True,
-            'risk_level': 'low'
-        },
-        {
-            'method': 'airplane_mode',
-            'name': 'Режим полета',
-            'description': 'Включение и отключение режима полета',
-            'recommended': False,
-            'risk_level': 'medium'
-        },
-        {
-            'method': 'usb_reconnect',
-            'name': 'Переподключение USB',
-            'description': 'Переподключение USB tethering',
-            'recommended': False,
-            'risk_level': 'medium'
-        }
-    ]
-
     return {
         "device_id": device_id,
         "device_type": "android",
-        "available_methods": rotation_methods,
+        "available_methods": _ANDROID_ROTATION_METHODS,
         "current_method": device_info.get('rotation_method', 'data_toggle'),
         "device_status": device_info.get('status', 'unknown')
     }
 
 
-async def test_device_rotation(device_id: str, method: str) -> dict:
+async def test_device_rotation(device_id: str, method: str, max_wait_seconds: float = 20.0,
+                               poll_interval: float = 1.0, verify_ip: bool = True) -> dict:
     """Тестирование метода ротации устройства с поддержкой USB"""
-    device_manager = get_device_manager()
-    modem_manager = get_modem_manager()
-
-    if not device_manager and not modem_manager:
-        return {"error": "No device managers available"}
-
+    stage = "lookup"
     try:
-        device_info = None
-        device_type = None
-
-        # Ищем устройство в DeviceManager
-        if device_manager:
-            all_devices = await device_manager.get_all_devices()
-            if device_id in all_devices:
-                device_info = all_devices[device_id]
-                device_type = "android"
-
-        # Ищем устройство в ModemManager
-        if not device_info and modem_manager:
-            all_modems = await modem_manager.get_all_devices()
-            if device_id in all_modems:
-                device_info = all_modems[device_id]
-                device_type = "usb_modem"
-
+        device_info, device_type = await _find_device_in_managers(device_id)
         if not device_info:
             return {"error": "Device not found"}
 
@@ -415,34 +473,33 @@ async def test_device_rotation(device_id: str, method: str) -> dict:
         # Для USB модемов принудительно используем USB перезагрузку
         if device_type == "usb_modem":
             method = "usb_reboot"
-            logger.info(f"Testing USB reboot method for device {device_id}")
+            logger.info("Testing USB reboot method", device_id=device_id)
+
+        manager = await (ensure_device_manager() if device_type == "android" else ensure_modem_manager())
 
         # Получаем текущий IP
-        current_ip = None
-        if device_type == "android" and device_manager:
-            current_ip = await device_manager.get_device_external_ip(device_id)
-        elif device_type == "usb_modem" and modem_manager:
-            current_ip = await modem_manager.get_device_external_ip(device_id)
+        stage = "ip_before"
+        current_ip = await asyncio.wait_for(manager.get_device_external_ip(device_id), TEST_IP_CHECK_TIMEOUT)
 
         # Выполняем тестовую ротацию
-        import time
-        start_time = time.time()
+        start_time = time.monotonic()
 
-        logger.info(f"Testing rotation method '{method}' for device {device_id} (UUID: {device_uuid})")
+        logger.info("Testing rotation method", device_id=device_id, device_uuid=device_uuid, method=method)
 
-        # Используем perform_device_rotation для тестирования
-        success, result = await perform_device_rotation(device_id, method)
-        execution_time = time.time() - start_time
+        # Используем perform_device_rotation для тестирования;
+        # shield - по таймауту перестаем ждать, но не прерываем USB перезагрузку на середине
+        stage = "rotation"
+        success, result = await asyncio.wait_for(asyncio.shield(perform_device_rotation(
+            device_id, method, device_type=device_type, device_uuid=device_uuid
+        )), TEST_ROTATION_TIMEOUT)
+        execution_time = time.monotonic() - start_time
 
-        # Ждем стабилизации
-        await asyncio.sleep(10)
-
-        # Проверяем новый IP
+        # Новый IP проверяем только после успешной ротации - иначе ожидание стабилизации бессмысленно;
+        # опрашиваем до смены IP с растущими паузами вместо фиксированной паузы
         new_ip = None
-        if device_type == "android" and device_manager:
-            new_ip = await device_manager.get_device_external_ip(device_id)
-        elif device_type == "usb_modem" and modem_manager:
-            new_ip = await modem_manager.get_device_external_ip(device_id)
+        if success and verify_ip:
+            stage = "ip_after"
+            new_ip = await _wait_for_ip_change(manager, device_id, current_ip, max_wait_seconds, poll_interval)
 
         ip_changed = new_ip != current_ip if current_ip and new_ip else False
 
@@ -462,89 +519,123 @@ async def test_device_rotation(device_id: str, method: str) -> dict:
             "usb_reboot_note": "USB reboot method used for reliable IP rotation" if device_type == "usb_modem" else None
         }
 
+    except asyncio.TimeoutError:
+        logger.error("Rotation test timed out", device_id=device_id, stage=stage)
+        return {"error": "operation timed out", "stage": stage}
+
     except Exception as e:
-        logger.error(f"Error testing rotation: {e}")
+        logger.error("Error testing rotation", device_id=device_id, error=str(e))
         return {"error": str(e)}
 
 
+async def _wait_for_ip_change(manager, device_id: str, previous_ip: Optional[str], max_wait_seconds: float,
+                              poll_interval: float) -> Optional[str]:
+    """Опрос внешнего IP устройства, пока он не сменится или не выйдет время: последний полученный IP"""
+    deadline = time.monotonic() + max_wait_seconds
+    new_ip = None
+    delay = poll_interval
+
+    while time.monotonic() < deadline:
+        # Каждый опрос - внешний запрос, поэтому паузы растут: 1, 2, 4, 8... секунд
+        await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay *= 2
+        try:
+            ip = await asyncio.wait_for(manager.get_device_external_ip(device_id), TEST_IP_CHECK_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Сразу после перезагрузки модем может быть еще недоступен - пробуем снова
+            continue
+
+        if ip:
+            new_ip = ip
+            if ip != previous_ip:
+                break
+
+    return new_ip
+
+
+async def _find_device_in_managers(device_id: str) -> tuple[Optional[dict], Optional[str]]:
+    """Поиск устройства по ID в менеджерах: (информация об устройстве, тип)"""
+    cached = _id_index_cache.get(device_id)
+    if cached and time.monotonic() - cached[1] < DEVICE_ID_INDEX_TTL:
+        device_type = cached[0]
+        manager = await (ensure_device_manager() if device_type == "android" else ensure_modem_manager())
+        device_info = await manager.get_device_by_id(device_id)
+        if device_info:
+            return device_info, device_type
+
+    # Ищем в обоих менеджерах параллельно; Android устройство в приоритете
+    android_info, modem_info = await _call_both_managers('get_device_by_id', device_id)
+    if android_info:
+        device_info, device_type = android_info, "android"
+    elif modem_info:
+        device_info, device_type = modem_info, "usb_modem"
+    else:
+        _id_index_cache.pop(device_id, None)
+        return None, None
+
+    _id_index_cache[device_id] = (device_type, time.monotonic())
+    return device_info, device_type
+
+
+async def _call_both_managers(method: str, *args) -> tuple[Any, Any]:
+    """Параллельный вызов метода DeviceManager и ModemManager: (android, usb_modem), None при ошибке"""
+
+    async def call(ensure_manager):
+        manager = await ensure_manager()
+        return await getattr(manager, method)(*args)
+
+    results = await asyncio.gather(
+        call(ensure_device_manager), call(ensure_modem_manager), return_exceptions=True
+    )
+
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error calling {method} on device manager: {result}")
+
+    android, usb_modem = (None if isinstance(result, Exception) else result for result in results)
+    return android, usb_modem
+
+
 async def get_all_devices_combined() -> Dict[str, dict]:
     """Получение всех устройств из обоих менеджеров"""
     combined_devices = {}
 
-    try:
-        # Получаем Android устройства
-        device_manager = get_device_manager()
-        if device_manager:
-            android_devices = await device_manager.get_all_devices()
-            combined_devices.update(android_devices)
-
-        # Получаем USB модемы
-        modem_manager = get_modem_manager()
-        if modem_manager:
-            usb_modems = await modem_manager.get_all_devices()
-            combined_devices.update(usb_modems)
-
-    except Exception as e:
-        logger.error(f"Error getting combined devices: {e}")
+    android_devices, usb_modems = await _call_both_managers('get_all_devices')
+    if android_devices:
+        combined_devices.update(android_devices)
+    if usb_modems:
+        combined_devices.update(usb_modems)
 
     return combined_devices
 
 
 async def get_online_devices_combined() -> List[dict]:
     """Получение всех онлайн устройств из обоих менеджеров"""
-    online_devices = []
-
-    try:
-        # Получаем онлайн Android устройства
-        device_manager = get_device_manager()
-        if device_manager:
-            android_devices = await device_manager.get_available_devices()
-            online_devices.extend(android_devices)
-
-        # Получаем онлайн USB модемы
-        modem_manager = get_modem_manager()
-        if modem_manager:
-            usb_modems = await modem_manager.get_available_devices()
-            online_devices.extend(usb_modems)
-
-    except Exception as e:
-        logger.error(f"Error getting online devices: {e}")
-
-    return online_devices
+    android_devices, usb_modems = await _call_both_managers('get_available_devices')
+    return list(chain(android_devices or (), usb_modems or ()))
 
 
 async def get_random_device_combined() -> Optional[dict]:
     """Получение случайного онлайн устройства из обоих менеджеров"""
-    online_devices = await get_online_devices_combined()
+    android_devices, usb_modems = await _call_both_managers('get_available_devices')
+    android_devices = android_devices or []
+    usb_modems = usb_modems or []
 
-    if not online_devices:
+    # Равномерный выбор по общему индексу - без объединения списков
+    total = len(android_devices) + len(usb_modems)
+    if not total:
         return None
 
-    import random
-    return random.choice(online_devices)
+    index = random.randrange(total)
+    if index < len(android_devices):
+        return android_devices[index]
+    return usb_modems[index - len(android_devices)]
 
 
 async def get_device_by_id_combined(device_id: str) -> Optional[dict]:
     """Получение устройства по ID из любого менеджера"""
-    try:
-        # Ищем в DeviceManager
-        device_manager = get_device_manager()
-        if device_manager:
-            device = await device_manager.get_device_by_id(device_id)
-            if device:
-                return device
-
-        # Ищем в ModemManager
-        modem_manager = get_modem_manager()
-        if modem_manager:
-            device = await modem_manager.get_device_by_id(device_id)
-            if device:
-                return device
-
-    except Exception as e:
-        logger.error(f"Error getting device by ID: {e}")
-
-    return None
+    device_info, _ = await _find_device_in_managers(device_id)
+    return device_info
 
 
 async def get_devices_summary_combined() -> Dict[str, Any]:
@@ -559,10 +650,10 @@ async def get_devices_summary_combined() -> Dict[str, Any]:
             "last_update": datetime.now().isoformat()
         }
 
+        android_summary, modem_summary = await _call_both_managers('get_summary')
+
         # Статистика Android устройств
-        device_manager = get_device_manager()
-        if device_manager:
-            android_summary = await device_manager.get_summary()
+        if android_summary:
             summary["android_devices"] = {
                 "total": android_summary.get("total_devices", 0),
                 "online": android_summary.get("online_devices", 0),
@@ -570,9 +661,7 @@ async def get_devices_summary_combined() -> Dict[str, Any]:
             }
 
         # Статистика USB модемов
-        modem_manager = get_modem_manager()
-        if modem_manager:
-            modem_summary = await modem_manager.get_summary()
+        if modem_summary:
             summary["usb_modems"] = {
                 "total": modem_summary.get("total_devices", 0),
                 "online": modem_summary.get("online_devices", 0),
@@ -598,51 +687,45 @@ async def get_devices_summary_combined() -> Dict[str, Any]:
         }
 
 
-async def get_device_uuid_by_name(device_name: str) -> Optional[str]:
-    """Получение UUID устройства по его имени из базы данных"""
-    try:
-        from ..models.database import AsyncSessionLocal
-        from ..models.base import ProxyDevice
-        from sqlalchemy import select
-
-        async with AsyncSessionLocal() as db:
-            stmt = select(ProxyDevice.id).where(ProxyDevice.name == device_name)
-            result = await db.execute(stmt)
-            device_uuid = result.scalar_one_or_none()
+# Публичное имя того же кэшируемого поиска UUID по имени
+get_device_uuid_by_name = _get_device_uuid_by_name
 
-            if device_uuid:
-                return str(device_uuid)
-            else:
-                logger.warning(f"Device not found in database: {device_name}")
-                return None
 
-    except Exception as e:
-        logger.error(f"Error getting device UUID by name: {e}")
-        return None
+def _as_uuid(value: Union[str, uuid.UUID]) -> uuid.UUID:
+    """UUID из строки; готовый uuid.UUID возвращается без повторного разбора"""
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(value)
 
 
-async def get_device_name_by_uuid(device_uuid: str) -> Optional[str]:
-    """Получение имени устройства по его UUID из базы данных"""
+async def _get_device_name_and_type_by_uuid(device_uuid: Union[str, uuid.UUID]) -> tuple[Optional[str], Optional[str]]:
+    """Получение имени и типа устройства по его UUID из базы данных одним запросом"""
     try:
-        from ..models.database import AsyncSessionLocal
-        from ..models.base import ProxyDevice
-        from sqlalchemy import select
-        import uuid
+        parsed_uuid = _as_uuid(device_uuid)
+        cache_key = str(parsed_uuid)
+
+        cached = _device_uuid_lookup_cache.get(cache_key)
+        if cached and time.monotonic() - cached[2] < DEVICE_LOOKUP_CACHE_TTL:
+            return cached[0], cached[1]
 
         async with AsyncSessionLocal() as db:
-            stmt = select(ProxyDevice.name).where(ProxyDevice.id == uuid.UUID(device_uuid))
-            result = await db.execute(stmt)
-            device_name = result.scalar_one_or_none()
+            result = await db.execute(_STMT_NAME_TYPE_BY_UUID, {'id': parsed_uuid})
+            row = result.one_or_none()
+
+        if row:
+            _remember_device_lookup(row.name, cache_key, row.device_type, time.monotonic())
+            return row.name, row.device_type
 
-            if device_name:
-                return device_name
-            else:
-                logger.warning(f"Device not found in database by UUID: {device_uuid}")
-                return None
+        logger.warning("Device not found in database by UUID", device_uuid=str(device_uuid))
+        return None, None
 
     except Exception as e:
-        logger.error(f"Error getting device name by UUID: {e}")
-        return None
+        logger.error("Error getting device name and type by UUID", device_uuid=str(device_uuid), error=str(e))
+        return None, None
+
+
+async def get_device_name_by_uuid(device_uuid: Union[str, uuid.UUID]) -> Optional[str]:
+    """Получение имени устройства по его UUID из базы данных"""
+    device_name, _ = await _get_device_name_and_type_by_uuid(device_uuid)
+    return device_name
 
 
 async def get_device_by_id_combined_with_uuid(device_id: str) -> Optional[dict]:
@@ -668,49 +751,46 @@ async def get_device_by_id_combined_with_uuid(device_id: str) -> Optional[dict]:
 async def sync_device_managers_with_database():
     """Синхронизация данных из менеджеров устройств с базой данных"""
     try:
-        from ..models.database import AsyncSessionLocal
-        from ..models.base import ProxyDevice
-        from sqlalchemy import select, update
-
         logger.info("Starting device managers sync with database...")
 
         # Получаем все устройства из менеджеров
         all_devices = await get_all_devices_combined()
+        if not all_devices:
+            return
+
+        # Все изменения - одним UPDATE ... FROM (VALUES ...) по имени устройства
+        device_values = values(
+            column('name', String), column('status', String), column('external_ip', String), name='v'
+        ).data([
+            (device_name, device_info.get('status', 'unknown'), device_info.get('external_ip') or None)
+            for device_name, device_info in all_devices.items()
+        ])
+        stmt = update(ProxyDevice).where(
+            ProxyDevice.name == device_values.c.name
+        ).values(
+            status=device_values.c.status,
+            last_heartbeat=datetime.now(),
+            # Внешний IP обновляем только если менеджер его знает
+            current_external_ip=func.coalesce(device_values.c.external_ip, ProxyDevice.current_external_ip)
+        ).returning(ProxyDevice.name).execution_options(synchronize_session=False)
 
         # Синхронизируем с базой данных
         async with AsyncSessionLocal() as db:
-            for device_name, device_info in all_devices.items():
-                # Проверяем, есть ли устройство в БД
-                stmt = select(ProxyDevice).where(ProxyDevice.name == device_name)
-                result = await db.execute(stmt)
-                db_device = result.scalar_one_or_none()
-
-                if db_device:
-                    # Обновляем статус и внешний IP
-                    update_data = {
-                        'status': device_info.get('status', 'unknown'),
-                        'last_heartbeat': datetime.now()
-                    }
-
-                    # Обновляем внешний IP если есть
-                    external_ip = device_info.get('external_ip')
-                    if external_ip:
-                        update_data['current_external_ip'] = external_ip
-
-                    stmt = update(ProxyDevice).where(
-                        ProxyDevice.name == device_name
-                    ).values(**update_data)
-
-                    await db.execute(stmt)
-                    logger.debug(f"Updated device {device_name} in database")
-                else:
-                    logger.warning(f"Device {device_name} found in managers but not in database")
+            result = await db.execute(stmt)
+            updated = set(result.scalars())
+            logger.debug("Updated devices in database", count=len(updated))
+
+            for device_name in all_devices.keys() - updated:
+                logger.warning("Device found in managers but not in database", device_name=device_name)
 
             await db.commit()
             logger.info("✅ Device managers sync completed")
 
+        # После синхронизации имена/типы в БД могли измениться
+        _clear_device_lookup_caches()
+
     except Exception as e:
-        logger.error(f"Error syncing device managers with database: {e}")
+        logger.error("Error syncing device managers with database", error=str(e))
 
 
 async def get_all_devices_with_uuid() -> Dict[str, dict]:
@@ -718,13 +798,23 @@ async def get_all_devices_with_uuid() -> Dict[str, dict]:
     try:
         # Получаем все устройства
         all_devices = await get_all_devices_combined()
+        if not all_devices:
+            return all_devices
 
-        # Добавляем UUID к каждому устройству
-        for device_name, device_info in all_devices.items():
-            device_uuid = await get_device_uuid_by_name(device_name)
-            if device_uuid:
-                device_info['uuid'] = device_uuid
-                device_info['database_id'] = device_uuid
+        # UUID всех устройств - одним запросом
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(_STMT_IDS_TYPES_BY_NAMES, {'names': list(all_devices)})
+            rows = result.all()
+
+        now = time.monotonic()
+        for device_name, device_id, device_type in rows:
+            device_uuid = str(device_id)
+            _remember_device_lookup(device_name, device_uuid, device_type, now)
+
+            # Добавляем UUID к устройству
+            device_info = all_devices[device_name]
+            device_info['uuid'] = device_uuid
+            device_info['database_id'] = device_uuid
 
         return all_devices
 
@@ -735,56 +825,36 @@ async def get_all_devices_with_uuid() -> Dict[str, dict]:
 
 async def perform_device_rotation_by_uuid(device_uuid: str, method: str = None) -> tuple[bool, str]:
     """Выполнение ротации устройства по UUID с поддержкой USB перезагрузки"""
-    rotation_manager = get_enhanced_rotation_manager()
-    if not rotation_manager:
-        return False, "Enhanced rotation manager not available"
-
     try:
-        logger.info(f"Performing rotation for device UUID: {device_uuid} with method: {method}")
+        rotation_manager = await ensure_enhanced_rotation_manager()
+
+        logger.info("Performing rotation by UUID", device_uuid=device_uuid, method=method)
 
         # Для USB модемов принудительно используем USB перезагрузку
         device_type = await _get_device_type_by_uuid(device_uuid)
         if device_type == 'usb_modem':
-            logger.info(f"USB modem detected, forcing USB reboot method for UUID {device_uuid}")
+            logger.info("USB modem detected, forcing USB reboot method", device_uuid=device_uuid)
             method = 'usb_reboot'
 
         # Выполняем ротацию
         success, result = await rotation_manager.rotate_device_ip(device_uuid, force_method=method)
 
         if success:
-            logger.info(f"✅ Rotation successful for UUID {device_uuid}: {result}")
+            logger.info("✅ Rotation successful", device_uuid=device_uuid, result=result)
             return True, result
         else:
-            logger.error(f"❌ Rotation failed for UUID {device_uuid}: {result}")
+            logger.error("❌ Rotation failed", device_uuid=device_uuid, result=result)
             return False, result
 
     except Exception as e:
-        logger.error(f"Error in device rotation by UUID: {e}")
+        logger.error("Error in device rotation by UUID", device_uuid=device_uuid, error=str(e))
         return False, f"Rotation error: {str(e)}"
 
 
-async def _get_device_type_by_uuid(device_uuid: str) -> Optional[str]:
+async def _get_device_type_by_uuid(device_uuid: Union[str, uuid.UUID]) -> Optional[str]:
     """Получение типа устройства по его UUID из базы данных"""
-    try:
-        from ..models.database import AsyncSessionLocal
-        from ..models.base import ProxyDevice
-        from sqlalchemy import select
-        import uuid
-
-        async with AsyncSessionLocal() as db:
-            stmt = select(ProxyDevice.device_type).where(ProxyDevice.id == uuid.UUID(device_uuid))
-            result = await db.execute(stmt)
-            device_type = result.scalar_one_or_none()
-
-            if device_type:
-                return device_type
-            else:
-                logger.warning(f"Device type not found in database by UUID: {device_uuid}")
-                return None
-
-    except Exception as e:
-        logger.error(f"Error getting device type by UUID: {e}")
-        return None
+    _, device_type = await _get_device_name_and_type_by_uuid(device_uuid)
+    return device_type
 
 
 async def get_device_rotation_methods_by_uuid(device_uuid: str) -> dict:
@@ -806,16 +876,15 @@ async def get_device_rotation_methods_by_uuid(device_uuid: str) -> dict:
 async def test_device_rotation_by_uuid(device_uuid: str, method: str) -> dict:
     """Тестирование метода ротации устройства по UUID"""
     try:
-        # Получаем имя устройства по UUID
-        device_name = await get_device_name_by_uuid(device_uuid)
+        # Имя и тип устройства - одним запросом
+        device_name, device_type = await _get_device_name_and_type_by_uuid(device_uuid)
         if not device_name:
             return {"error": "Device not found by UUID"}
 
         # Для USB модемов принудительно используем USB перезагрузку
-        device_type = await _get_device_type_by_uuid(device_uuid)
         if device_type == 'usb_modem':
             method = 'usb_reboot'
-            logger.info(f"USB modem detected, forcing USB reboot method for UUID {device_uuid}")
+            logger.info("USB modem detected, forcing USB reboot method", device_uuid=device_uuid)
 
         # Выполняем тест через имя устройства
         result = await test_device_rotation(device_name, method)
@@ -827,10 +896,173 @@ async def test_device_rotation_by_uuid(device_uuid: str, method: str) -> dict:
         return result
 
     except Exception as e:
-        logger.error(f"Error testing rotation by UUID: {e}")
+        logger.error("Error testing rotation by UUID", device_uuid=device_uuid, error=str(e))
         return {"error": str(e)}
 
 
+async def _run_probe(*argv: str, timeout: float = PROBE_TIMEOUT) -> tuple[int, bytes, bytes]:
+    """Запуск диагностической команды: (код возврата, stdout, stderr)"""
+    async with _probe_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except BaseException:
+            # При отмене или таймауте не оставляем процесс висеть без ожидания
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+            raise
+        return process.returncode, stdout, stderr
+
+
+async def _probe_succeeds(*argv: str) -> bool:
+    """Успешно ли выполняется диагностическая команда"""
+    try:
+        returncode, _, _ = await _run_probe(*argv)
+        return returncode == 0
+    except Exception:
+        return False
+
+
+def _read_sysfs_attr(device_path: str, name: str) -> str:
+    """Чтение атрибута USB устройства из sysfs (пустая строка, если его нет)"""
+    try:
+        with open(os.path.join(device_path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def _scan_huawei_sysfs() -> List[tuple[str, str]]:
+    """Поиск USB устройств Huawei в sysfs: [(путь к idVendor, описание в формате lsusb)]"""
+    devices = []
+    for entry in os.scandir(USB_SYSFS_DEVICES):
+        if _read_sysfs_attr(entry.path, 'idVendor') != HUAWEI_VENDOR_ID:
+            continue
+
+        attrs = {name: _read_sysfs_attr(entry.path, name)
+                 for name in ('busnum', 'devnum', 'idProduct', 'manufacturer', 'product')}
+        label = (f"Bus {attrs['busnum'].zfill(3)} Device {attrs['devnum'].zfill(3)}: "
+                 f"ID {HUAWEI_VENDOR_ID}:{attrs['idProduct']} {attrs['manufacturer']} {attrs['product']}")
+        devices.append((os.path.join(entry.path, 'idVendor'), label.rstrip()))
+    return devices
+
+
+async def _find_huawei_devices() -> List[tuple[Optional[str], str]]:
+    """USB устройства Huawei: [(путь к idVendor или None, описание)]; lsusb - только если sysfs недоступен"""
+    if os.path.isdir(USB_SYSFS_DEVICES):
+        return await asyncio.to_thread(_scan_huawei_sysfs)
+
+    returncode, stdout, stderr = await _run_probe('lsusb')
+    if returncode != 0:
+        raise RuntimeError(stderr.decode())
+    vendor_id = HUAWEI_VENDOR_ID.encode()
+    return [(None, line.decode('utf-8', 'replace')) for line in stdout.splitlines() if vendor_id in line]
+
+
+async def _cached_probe(key: str, ttl: float, probe: Callable[[], Awaitable[Any]]) -> Any:
+    """Результат проверки из кэша; одновременные промахи по ключу выполняют проверку один раз"""
+    cached = _probe_cache.get(key)
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+
+    async with _probe_locks[key]:
+        cached = _probe_cache.get(key)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+
+        value = await probe()
+        _probe_cache[key] = (time.monotonic(), value)
+        return value
+
+
+async def _check_sudo_access() -> bool:
+    """Доступен ли sudo без пароля (результат кэшируется на SUDO_STATUS_TTL)"""
+    return await _cached_probe('sudo_access', SUDO_STATUS_TTL, lambda: _probe_succeeds('sudo', '-n', 'true'))
+
+
+async def _collect_usb_probes() -> dict:
+    """Общий снимок USB проверок для диагностики и теста возможностей (кэшируется на USB_PROBES_TTL)"""
+    return await _cached_probe('usb_probes', USB_PROBES_TTL, _run_usb_probes)
+
+
+async def _run_usb_probes() -> dict:
+    """Сбор USB проверок: sudo, наличие команд и sysfs, список модемов Huawei"""
+    sudo_access, huawei_devices = await asyncio.gather(
+        _check_sudo_access(),
+        _find_huawei_devices(),
+        return_exceptions=True
+    )
+
+    huawei_error = None
+    if isinstance(huawei_devices, BaseException):
+        huawei_error = str(huawei_devices)
+        huawei_devices = []
+
+    return {
+        "sudo_access": sudo_access is True,
+        # Наличие команд в PATH, без запуска
+        "lsusb_available": shutil.which('lsusb') is not None,
+        "curl_available": shutil.which('curl') is not None,
+        "usb_sysfs_available": os.path.isdir(USB_SYSFS_DEVICES),
+        "huawei_devices": huawei_devices,
+        "huawei_error": huawei_error
+    }
+
+
+def _test_usb_device_discovery(probes: dict) -> dict:
+    """Тест 1: Поиск USB устройств Huawei"""
+    if probes["huawei_error"]:
+        return {
+            "success": False,
+            "error": probes["huawei_error"]
+        }
+
+    huawei_devices = [label for _, label in probes["huawei_devices"]]
+    return {
+        "success": len(huawei_devices) > 0,
+        "devices_found": len(huawei_devices),
+        "devices": huawei_devices
+    }
+
+
+def _test_usb_sysfs_access(probes: dict) -> dict:
+    """Тест 2: Проверка доступа к sysfs"""
+    if not probes["usb_sysfs_available"]:
+        return {
+            "success": False,
+            "error": f"{USB_SYSFS_DEVICES} is not available"
+        }
+    if probes["huawei_error"]:
+        return {
+            "success": False,
+            "error": probes["huawei_error"]
+        }
+
+    vendor_files = [path for path, _ in probes["huawei_devices"]]
+    return {
+        "success": len(vendor_files) > 0,
+        "huawei_devices_in_sysfs": len(vendor_files),
+        "vendor_files": vendor_files
+    }
+
+
+def _test_sudo_access(probes: dict) -> dict:
+    """Тест 3: Проверка sudo доступа"""
+    sudo_access = probes["sudo_access"]
+    return {
+        "success": sudo_access,
+        "message": "sudo access available" if sudo_access else "sudo access required"
+    }
+
+
 async def get_usb_rotation_diagnostics() -> dict:
     """Получение диагностической информации о USB ротации"""
     try:
@@ -848,74 +1080,21 @@ async def get_usb_rotation_diagnostics() -> dict:
             "diagnostics": {}
         }
 
-        # Проверяем доступность sudo
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'sudo', '-n', 'true',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
-            diagnostics["diagnostics"]["sudo_access"] = result.returncode == 0
-        except Exception:
-            diagnostics["diagnostics"]["sudo_access"] = False
-
-        # Проверяем доступность lsusb
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'lsusb',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
-            diagnostics["diagnostics"]["lsusb_available"] = result.returncode == 0
-        except Exception:
-            diagnostics["diagnostics"]["lsusb_available"] = False
-
-        # Проверяем наличие USB устройств Huawei
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'lsusb',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode == 0:
-                lsusb_output = stdout.decode()
-                huawei_devices = [line for line in lsusb_output.split('\n') if '12d1' in line and 'Huawei' in line]
-                diagnostics["diagnostics"]["huawei_devices_found"] = len(huawei_devices)
-                diagnostics["diagnostics"]["huawei_devices"] = huawei_devices
-            else:
-                diagnostics["diagnostics"]["huawei_devices_found"] = 0
-                diagnostics["diagnostics"]["huawei_devices"] = []
-        except Exception:
-            diagnostics["diagnostics"]["huawei_devices_found"] = 0
-            diagnostics["diagnostics"]["huawei_devices"] = []
-
-        # Проверяем доступность curl
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'curl', '--version',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
-            diagnostics["diagnostics"]["curl_available"] = result.returncode == 0
-        except Exception:
-            diagnostics["diagnostics"]["curl_available"] = False
-
-        # Проверяем доступность /sys/bus/usb/devices
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'test', '-d', '/sys/bus/usb/devices',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await result.communicate()
-            diagnostics["diagnostics"]["usb_sysfs_available"] = result.returncode == 0
-        except Exception:
-            diagnostics["diagnostics"]["usb_sysfs_available"] = False
+        probes = await _collect_usb_probes()
+        checks = diagnostics["diagnostics"]
+
+        # Доступность sudo и lsusb
+        checks["sudo_access"] = probes["sudo_access"]
+        checks["lsusb_available"] = probes["lsusb_available"]
+
+        # Наличие USB устройств Huawei
+        huawei_devices = [label for _, label in probes["huawei_devices"]]
+        checks["huawei_devices_found"] = len(huawei_devices)
+        checks["huawei_devices"] = huawei_devices
+
+        # Доступность curl и /sys/bus/usb/devices
+        checks["curl_available"] = probes["curl_available"]
+        checks["usb_sysfs_available"] = probes["usb_sysfs_available"]
 
         # Общая готовность системы
         required_checks = [
@@ -949,82 +1128,11 @@ async def test_usb_rotation_capability() -> dict:
             "results": {}
         }
 
-        # Тест 1: Поиск USB устройств Huawei
-        logger.info("Testing USB device discovery...")
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'lsusb',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode == 0:
-                lsusb_output = stdout.decode()
-                huawei_devices = [line for line in lsusb_output.split('\n') if '12d1' in line]
-                test_results["results"]["device_discovery"] = {
-                    "success": len(huawei_devices) > 0,
-                    "devices_found": len(huawei_devices),
-                    "devices": huawei_devices
-                }
-            else:
-                test_results["results"]["device_discovery"] = {
-                    "success": False,
-                    "error": stderr.decode()
-                }
-        except Exception as e:
-            test_results["results"]["device_discovery"] = {
-                "success": False,
-                "error": str(e)
-            }
-
-        # Тест 2: Проверка доступа к sysfs
-        logger.info("Testing sysfs access...")
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'find', '/sys/bus/usb/devices/', '-name', 'idVendor', '-exec', 'grep', '-l', '12d1', '{}', ';',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            if result.returncode == 0:
-                vendor_files = [f for f in stdout.decode().split('\n') if f]
-                test_results["results"]["sysfs_access"] = {
-                    "success": len(vendor_files) > 0,
-                    "huawei_devices_in_sysfs": len(vendor_files),
-                    "vendor_files": vendor_files
-                }
-            else:
-                test_results["results"]["sysfs_access"] = {
-                    "success": False,
-                    "error": stderr.decode()
-                }
-        except Exception as e:
-            test_results["results"]["sysfs_access"] = {
-                "success": False,
-                "error": str(e)
-            }
-
-        # Тест 3: Проверка sudo доступа
-        logger.info("Testing sudo access...")
-        try:
-            result = await asyncio.create_subprocess_exec(
-                'sudo', '-n', 'echo', 'test',
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-
-            test_results["results"]["sudo_access"] = {
-                "success": result.returncode == 0,
-                "message": "sudo access available" if result.returncode == 0 else "sudo access required"
-            }
-        except Exception as e:
-            test_results["results"]["sudo_access"] = {
-                "success": False,
-                "error": str(e)
-            }
+        # Все три теста - по одному общему снимку проверок
+        probes = await _collect_usb_probes()
+        test_results["results"]["device_discovery"] = _test_usb_device_discovery(probes)
+        test_results["results"]["sysfs_access"] = _test_usb_sysfs_access(probes)
+        test_results["results"]["sudo_access"] = _test_sudo_access(probes)
 
         # Общий результат
         all_tests = list(test_results["results"].values())
@@ -19,6 +19,9 @@ from ..models.base import ProxyDevice
 
 logger = structlog.get_logger()
 
+# Время (сек), в течение которого не опрашиваем недоступный веб-интерфейс повторно
+WEB_PROBE_FAIL_TTL = 60
+
 
 class ModemManager:
     """Менеджер для работы с USB модемами Huawei E3372h"""
@@ -27,6 +30,8 @@ class ModemManager:
         self.modems: Dict[str, dict] = {}
         self.running = False
         self.huawei_oui = "0c:5b:8f"  # Официальный OUI Huawei Technologies Co.,Ltd.
+        # Негативный кэш проверок веб-интерфейса: {web_interface: expires_at}
+        self._web_probe_fail: Dict[str, float] = {}
 
     # backend/app/core/modem_manager.py - ИСПРАВЛЕННАЯ ВЕРСИЯ ДЛЯ ОБНАРУЖЕНИЯ МОДЕМОВ
 
@@ -35,6 +40,7 @@ class ModemManager:
         try:
             # Очищаем старый список
             self.modems.clear()
+            self._web_probe_fail.clear()
 
             logger.info("Starting optimized Huawei E3372h modem discovery...")
             start_time = time.time()
@@ -122,7 +128,7 @@ class ModemManager:
                     logger.info(f"Processing Huawei modem: {interface} (IP: {interface_ip}) -> Web: {web_interface}")
 
                     # Проверяем доступность веб-интерфейса
-                    web_accessible = await self.check_web_interface_accessibility(web_interface)
+                    web_accessible = await self.check_web_interface_accessibility(web_interface, skip_recent_failures=True)
 
                     # Получаем детальную информацию о модеме
                     modem_details = await self.get_modem_details(web_interface, interface_ip)
@@ -287,7 +293,7 @@ class ModemManager:
                 pass
 
         except Exception as e:
-            logger.debug(f"Error getting MAC for interface {interface}: {e}")
+            logger.debug("Error getting MAC for interface", interface=interface, error=str(e))
 
         return None
 
@@ -305,7 +311,7 @@ class ModemManager:
             return ip_info['addr']
 
         except Exception as e:
-            logger.debug(f"Error getting IP for interface {interface}: {e}")
+            logger.debug("Error getting IP for interface", interface=interface, error=str(e))
             return None
 
     async def extract_subnet_number(self, ip_address: str) -> Optional[int]:
@@ -322,12 +328,17 @@ class ModemManager:
                     logger.warning(f"Unexpected interface IP format: {ip_address} (expected xxx.xxx.xxx.100)")
                     return subnet_num  # Возвращаем все равно, может быть другая конфигурация
         except Exception as e:
-            logger.debug(f"Error extracting subnet number from {ip_address}: {e}")
+            logger.debug("Error extracting subnet number", ip_address=ip_address, error=str(e))
 
         return None
 
-    async def check_web_interface_accessibility(self, web_interface: str) -> bool:
+    async def check_web_interface_accessibility(self, web_interface: str, skip_recent_failures: bool = False) -> bool:
         """Проверка доступности веб-интерфейса модема - оптимизированная версия"""
+        # При сканировании: недавно не отвечал - не тратим timeout на повторную проверку.
+        # Проверки здоровья и статуса опрашивают всегда, чтобы восстановление было видно сразу
+        if skip_recent_failures and self._web_probe_fail.get(web_interface, 0) > time.monotonic():
+            return False
+
         try:
             url = f"http://{web_interface}"
             # Используем более короткий timeout для быстрого сканирования
@@ -336,10 +347,17 @@ class ModemManager:
             async with aiohttp.ClientSession(timeout=timeout) as session:
                 async with session.get(url) as response:
                     accessible = response.status == 200
-                    logger.debug(f"Web interface {web_interface} accessibility: {accessible}")
+                    logger.debug("Web interface accessibility", web_interface=web_interface, accessible=accessible)
+
+                    if response.status >= 500:
+                        self._web_probe_fail[web_interface] = time.monotonic() + WEB_PROBE_FAIL_TTL
+                    else:
+                        self._web_probe_fail.pop(web_interface, None)
+
                     return accessible
         except Exception as e:
-            logger.debug(f"Web interface {web_interface} not accessible: {e}")
+            logger.debug("Web interface not accessible", web_interface=web_interface, error=str(e))
+            self._web_probe_fail[web_interface] = time.monotonic() + WEB_PROBE_FAIL_TTL
             return False
 
     async def get_modem_details(self, web_interface: str, interface_ip: str) -> Optional[Dict[str, Any]]:
@@ -364,7 +382,7 @@ class ModemManager:
             })
 
         except Exception as e:
-            logger.debug(f"Error getting modem details for {web_interface}: {e}")
+            logger.debug("Error getting modem details", web_interface=web_interface, error=str(e))
 
         return details if details else None
 
@@ -377,7 +395,7 @@ class ModemManager:
                     return interface
             return None
         except Exception as e:
-            logger.debug(f"Error getting interface name for IP {target_ip}: {e}")
+            logger.debug("Error getting interface name for IP", target_ip=target_ip, error=str(e))
             return None
 
     async def get_external_ip_via_interface(self, interface_ip: str) -> Optional[str]:
@@ -415,7 +433,7 @@ class ModemManager:
                         return ip_match.group(1)
 
         except Exception as e:
-            logger.debug(f"Error getting external IP via interface {interface_ip}: {e}")
+            logger.debug("Error getting external IP via interface", interface_ip=interface_ip, error=str(e))
 
         return None
 
@@ -480,7 +498,7 @@ class ModemManager:
             if subnet_number is not None:
                 return f"192.168.{subnet_number}.1"
         except Exception as e:
-            logger.debug(f"Error getting web interface for device IP {device_ip}: {e}")
+            logger.debug("Error getting web interface for device IP", device_ip=device_ip, error=str(e))
         return None
 
     async def save_device_to_db(self, modem_id: str, modem_info: dict):
@@ -656,7 +674,7 @@ class ModemManager:
                 if external_ip:
                     # Обновляем кэш
                     modem['external_ip'] = external_ip
-                    logger.debug(f"Updated external IP for {modem_id}: {external_ip}")
+                    logger.debug("Updated external IP", modem_id=modem_id, external_ip=external_ip)
                     return external_ip
 
             # Альтернативный способ через интерфейс напрямую
@@ -666,7 +684,7 @@ class ModemManager:
                 if external_ip:
                     # Обновляем кэш
                     modem['external_ip'] = external_ip
-                    logger.debug(f"Updated external IP for {modem_id} via interface: {external_ip}")
+                    logger.debug("Updated external IP via interface", modem_id=modem_id, external_ip=external_ip)
                     return external_ip
 
             logger.warning(f"Could not get external IP for modem {modem_id}")
@@ -694,21 +712,21 @@ class ModemManager:
                     response = json.loads(stdout.decode())
                     external_ip = response.get('origin', '').split(',')[0].strip()
                     if external_ip:
-                        logger.debug(f"Got external IP via interface {interface_name}: {external_ip}")
+                        logger.debug("Got external IP via interface", interface=interface_name, external_ip=external_ip)
                         return external_ip
                 except json.JSONDecodeError:
                     # Пробуем найти IP в тексте
                     ip_match = re.search(r'(\d+\.\d+\.\d+\.\d+)', stdout.decode())
                     if ip_match:
                         external_ip = ip_match.group(1)
-                        logger.debug(f"Got external IP via interface {interface_name}: {external_ip}")
+                        logger.debug("Got external IP via interface", interface=interface_name, external_ip=external_ip)
                         return external_ip
 
-            logger.debug(f"Could not get external IP via interface {interface_name}: {stderr.decode()}")
+            logger.debug("Could not get external IP via interface", interface=interface_name, stderr=stderr.decode(errors="replace"))
             return None
 
         except Exception as e:
-            logger.debug(f"Error getting external IP via interface {interface_name}: {e}")
+            logger.debug("Error getting external IP via interface", interface=interface_name, error=str(e))
             return None
 
     async def update_device_status(self, modem_id: str, status: str):
@@ -809,8 +827,7 @@ class ModemManager:
 
     async def get_device_proxy_route(self, modem_id: str) -> Optional[dict]:
         """Получение маршрута для проксирования через модем"""
-        all_modems = await self.get_all_devices()
-        modem = all_modems.get(modem_id)
+        modem = await self.get_device_by_id(modem_id)
 
         if not modem:
             return None
@@ -1000,7 +1017,7 @@ class ModemManager:
                 )
                 await db.execute(stmt)
                 await db.commit()
-                logger.debug(f"Updated external IP in DB for {modem_id}: {external_ip}")
+                logger.debug("Updated external IP in DB", modem_id=modem_id, external_ip=external_ip)
         except Exception as e:
             logger.error(f"Error updating external IP in DB: {e}")
 
@@ -586,8 +586,6 @@ class ProxyServer:
 
         try:
             # Получаем IP адрес интерфейса
-            import netifaces
-
             if interface not in netifaces.interfaces():
                 raise Exception(f"Interface {interface} not found")
 
@@ -1,5 +1,6 @@
 import asyncio
 import aiohttp
+import netifaces
 from aiohttp import web, ClientSession, ClientTimeout
 import time
 from typing import Optional, Dict, Any
@@ -128,8 +129,6 @@ class SimpleProxyServer:
         try:
             # PPP интерфейс обычно создается автоматически
             # Нужно найти активный PPP интерфейс
-            import netifaces
-
             for interface in netifaces.interfaces():
                 if interface.startswith('ppp'):
                     return {
@@ -154,7 +153,6 @@ class SimpleProxyServer:
 
                 if interface:
                     # Проверяем что интерфейс активен
-                    import netifaces
                     if interface in netifaces.interfaces():
                         addresses = netifaces.ifaddresses(interface)
                         if netifaces.AF_INET in addresses:
@@ -172,7 +170,6 @@ class SimpleProxyServer:
 
             # Fallback: старый метод поиска
             logger.info("Falling back to interface discovery for Android")
-            import netifaces
             android_interfaces = ['usb0', 'rndis0', 'enp0s20u1']
 
             # Расширенный поиск интерфейсов
@@ -214,8 +211,6 @@ class SimpleProxyServer:
 
         try:
             # Получаем IP адрес интерфейса
-            import netifaces
-
             if interface not in netifaces.interfaces():
                 raise Exception(f"Interface {interface} not found")
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, Text, UUID
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, Text, UUID, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 import uuid
@@ -71,6 +71,9 @@ class RequestLog(Base):
 
 class IpHistory(Base):
     __tablename__ = "ip_history"
+    __table_args__ = (
+        UniqueConstraint('device_id', 'ip_address', name='ip_history_device_id_ip_address_key'),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     device_id = Column(UUID(as_uuid=True), nullable=False)